@@ -1,9 +1,18 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from utility_scripts.lru_cache import LRUCache
+from utility_scripts.ollama_scheduler import QUERY
 from utility_scripts.system_logging import setup_logger
-from apocrypha.vector_database import chunk_loader, load_embeddings, load_metadata, embed_content, \
-    load_or_create_faiss_index, append_to_faiss, json_builder, save_metadata, save_embeddings, save_faiss, get_faiss
+from apocrypha.knowledge_store import get_knowledge_store
+from apocrypha.vector_database import chunk_loader, open_embeddings, embed_batch, embed_batches, \
+    load_or_create_faiss_index, append_to_faiss, remove_from_faiss, ensure_id_map, get_faiss, json_builder, \
+    save_metadata_batch, save_faiss, content_hash, find_known_hashes, get_source_chunks, delete_metadata, \
+    update_chunk_indices, upgrade_index_if_needed, open_write_ahead_log, checkpoint, needs_recovery, recover_store, \
+    get_shard, list_shards, normalize_filters, lexical_terms, EMBED_BATCH_SIZE, EMBED_MAX_IN_FLIGHT, CHECKPOINT_EVERY
 
 # configure logging
 logger = setup_logger(__name__)
@@ -13,107 +22,559 @@ logging.getLogger("ollama").setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+# Recall caches, results are keyed by index generation so a new index invalidates them
+query_embedding_cache = LRUCache(max_entries=1024, ttl=60 * 60)
+recall_result_cache = LRUCache(max_entries=256, ttl=10 * 60)
+
+# Threads searching shards in parallel, FAISS releases the GIL while it searches
+SEARCH_THREADS = min(8, os.cpu_count() or 1)
+_search_pool = None
+
+# Hybrid recall, dense and BM25 rankings are merged with reciprocal rank fusion
+HYBRID_RECALL = True
+RRF_K = 60
+# A query is answered from BM25 alone, skipping the embedding call, when its best hit
+# contains every query term and outscores the runner-up by this factor
+LEXICAL_FAST_PATH_RATIO = 3.0
+# Hits found by BM25 but not by the dense search within max_distance are only recalled when
+# they contain every query term and the query has at least this many terms besides stopwords,
+# so a prompt sharing one word with a chunk does not pull it in as context
+LEXICAL_MIN_TERMS = 2
+
+# Candidates fetched per result when recall is reranked with maximal marginal relevance
+MMR_FETCH_FACTOR = 4
 
-def RetainKnowledge(path):
+
+def RetainKnowledge(path, source=None, shard=None, batch_size=EMBED_BATCH_SIZE, max_in_flight=EMBED_MAX_IN_FLIGHT):
     """
     Process a chunk file and retain its knowledge.
     :param path: The chunk file to process
+    :param source: URL the chunks were taken from
+    :param shard: shard to write to, the default shard if None
+    :param batch_size: Number of chunks embedded per request
+    :param max_in_flight: Maximum number of embedding batches running at once
+    :return: dict with the number of new and deduplicated chunks
+    """
+    shard = get_shard(shard)
+    logger.info(f"Retaining Knowledge > {path} ({shard.name})")
+
+    with shard.writing():
+        # finish any interrupted ingestion before looking at what is already known
+        recover_store(shard)
+
+        chunks = chunk_loader(path)
+
+        # Skip chunks already in the shard or repeated within this file
+        hashes = [content_hash(chunk["content"]) for chunk in chunks]
+        seen = find_known_hashes(hashes, shard)
+        new_chunks, new_hashes = [], []
+        for chunk, hash_content in zip(chunks, hashes):
+            if hash_content in seen:
+                continue
+            seen.add(hash_content)
+            new_chunks.append(chunk)
+            new_hashes.append(hash_content)
+
+        stats = {"new": len(new_chunks), "deduplicated": len(chunks) - len(new_chunks)}
+        logger.info(f"{stats['new']} new chunks, {stats['deduplicated']} already known")
+
+        if _retain_chunks(new_chunks, new_hashes, source, (), shard, batch_size, max_in_flight):
+            logger.info(f"Finished > {path}")
+        else:
+            logger.info(f"No New Chunks Found > {path}")
+    return stats
+
+
+def replace_source(url, chunks, shard=None, batch_size=EMBED_BATCH_SIZE, max_in_flight=EMBED_MAX_IN_FLIGHT):
+    """
+    Replace the stored chunks of a page with a fresh chunking of it.
+    Unchanged chunks keep their vectors, only removed and added chunks touch the index.
+    :param url: URL the chunks were taken from
+    :param chunks: list of {"chunk_id", "content"} as written by the chunker
+    :param shard: shard the page lives in, the default shard if None
+    :return: dict with the number of added, removed and unchanged chunks
+    """
+    shard = get_shard(shard)
+    logger.info(f"Replacing Knowledge > {url} ({shard.name})")
+
+    with shard.writing():
+        recover_store(shard)
+
+        stored = get_source_chunks(url, shard)
+        hashes = [content_hash(chunk["content"]) for chunk in chunks]
+
+        added_chunks, added_hashes, kept = [], [], {}
+        for chunk, hash_content in zip(chunks, hashes):
+            if hash_content in stored:
+                kept[stored[hash_content]] = chunk["chunk_id"]
+            elif hash_content not in added_hashes:
+                added_chunks.append(chunk)
+                added_hashes.append(hash_content)
+
+        current = set(hashes)
+        removed = [faiss_index for hash_content, faiss_index in stored.items() if hash_content not in current]
+
+        delete_metadata(removed, shard)
+        update_chunk_indices(kept, shard)
+        _retain_chunks(added_chunks, added_hashes, url, removed, shard, batch_size, max_in_flight)
+
+    stats = {"added": len(added_chunks), "removed": len(removed), "unchanged": len(kept)}
+    logger.info(f"Replaced {url}: {stats}")
+    return stats
+
+
+def delete_source(url, shard=None):
+    """
+    Remove every chunk of a page from the index and metadata.
+    Their rows stay in embeddings.npy until the store is compacted.
+    :param shard: shard the page lives in, the default shard if None
+    :return: number of removed chunks
+    """
+    shard = get_shard(shard)
+    with shard.writing():
+        # replaying an interrupted ingestion later would bring the deleted chunks back
+        recover_store(shard)
+
+        removed = list(get_source_chunks(url, shard).values())
+        if not removed:
+            logger.info(f"No Knowledge Stored For > {url}")
+            return 0
+
+        delete_metadata(removed, shard)
+        index = get_faiss(shard=shard)
+        if index is not None:
+            save_faiss(remove_from_faiss(ensure_id_map(index, shard), removed, shard), shard)
+
+    logger.info(f"Deleted {len(removed)} chunks of {url}")
+    return len(removed)
+
+
+def recover_shards(shards=None):
+    """
+    Check every shard and repair what an interrupted ingestion or compaction left behind, before serving recalls.
+    The check only reads, a shard is repaired when it finds a problem and no other process is writing to it.
+    A shard another process is writing to is left alone, that process leaves it consistent or repairs it.
+    :param shards: shard names, every shard if None
+    :return: dict of shard name -> repairs, only for shards that needed any
     """
-    logger.info(f"Retaining Knowledge > {path}")
+    repairs = {}
+    for name in (list_shards() if shards is None else shards):
+        shard = get_shard(name)
+        reasons = needs_recovery(shard)
+        if not reasons:
+            continue
 
-    chunks = chunk_loader(path)
-    all_embeddings = load_embeddings()
-    metadata = load_metadata()
+        with shard.write_lock:
+            if not shard.file_lock.acquire(blocking=False):
+                logger.info(f"Shard {shard.name} is being written by another process, not recovering it")
+                continue
+            try:
+                # the writer that held the lock may have finished in the meantime
+                reasons = needs_recovery(shard)
+                if reasons:
+                    logger.warning(f"Recovering shard {shard.name}: {'; '.join(reasons)}")
+                    found = recover_store(shard)
+                    if found:
+                        repairs[shard.name] = found
+            finally:
+                shard.file_lock.release()
+    return repairs
 
-    # Determine dimension from first chunk if embeddings are empty
-    first_dim = None
-    if all_embeddings.shape[0] > 0:
-        first_dim = all_embeddings.shape[1]
 
+def _retain_chunks(chunks, hashes, source, remove_ids, shard, batch_size, max_in_flight):
+    """
+    Embed chunks and append them to the embeddings cache, index and metadata of a shard.
+    The caller holds the shard's write lock.
+    :param remove_ids: chunk IDs to drop from the index in the same generation
+    :return: False if there was nothing to write
+    """
     index = None
 
     logger.info("Processing Chunks...")
-    for chunk in chunks:
-        chunk_id = chunk["chunk_id"]
-        content = chunk["content"]
+    contents = [chunk["content"] for chunk in chunks]
+    since_checkpoint = 0
+    with open_write_ahead_log(shard) as wal, open_embeddings(shard) as embeddings:
+        if len(remove_ids):
+            index = remove_from_faiss(load_or_create_faiss_index(embeddings.dim, shard), remove_ids, shard)
+
+        for start, vectors, dim in embed_batches(contents, batch_size, max_in_flight):
+            batch_chunks = chunks[start:start + len(vectors)]
+            batch_hashes = hashes[start:start + len(vectors)]
+
+            # Initialize FAISS if first time, dimension comes from the cache or the first batch
+            if index is None:
+                index = load_or_create_faiss_index(embeddings.dim or dim, shard)
+
+            # Check dimension consistency
+            if dim != index.d:
+                raise ValueError(f"Embedding dimension mismatch: {dim} != {index.d}")
+
+            # Create metadata entries, the embeddings row is the chunk's stable ID
+            first_idx = embeddings.count
+            ids = range(first_idx, first_idx + len(vectors))
+            entries = [
+                json_builder(chunk_id, chunk["chunk_id"], chunk["content"], hash_content, source)
+                for chunk_id, chunk, hash_content in zip(ids, batch_chunks, batch_hashes)
+            ]
+
+            # Log the batch before applying it so a crash loses no embedding work
+            wal.append(first_idx, vectors, entries)
+
+            # Append vectors to embeddings cache in place
+            embeddings.append(vectors)
+
+            # Append vectors to FAISS index
+            append_to_faiss(index, vectors, ids)
 
-        # Embed
-        vectors, dim = embed_content(content)
+            save_metadata_batch(entries, shard)
+
+            since_checkpoint += len(vectors)
+            if since_checkpoint >= CHECKPOINT_EVERY:
+                checkpoint(embeddings, wal)
+                since_checkpoint = 0
+
+            logger.debug(f"Embedded chunks {start + 1}-{start + len(vectors)} of {len(chunks)}")
 
-        # Initialize FAISS if first time
         if index is None:
-            if all_embeddings.shape[0] == 0:
-                first_dim = dim
-            else:
-                first_dim = all_embeddings.shape[1]
-            index = load_or_create_faiss_index(first_dim)
-
-        # Check dimension consistency
-        if dim != first_dim:
-            raise ValueError(f"Embedding dimension mismatch: {dim} != {first_dim}")
-
-        # Append vectors to embeddings cache
-        if all_embeddings.shape[0] == 0:
-            all_embeddings = vectors
-        else:
-            all_embeddings = np.vstack([all_embeddings, vectors])
+            return False
 
-        # Append vectors to FAISS index
-        append_to_faiss(index, vectors)
+        logger.info("Finished Chunks, Saving...")
+        embeddings.flush()
+        index = upgrade_index_if_needed(index, shard)
+        save_faiss(index, shard)
+        wal.reset()
 
-        # Create metadata entry
-        faiss_idx = all_embeddings.shape[0] - 1
-        chunk_metadata = json_builder(faiss_idx, chunk_id, content)
-        save_metadata(chunk_metadata)
+    return True
 
-    logger.info("Finished Chunks, Saving...")
-    # Save everything
-    save_embeddings(all_embeddings)
-    save_faiss(index)
 
-    logger.info(f"Finished > {path}")
+def normalize_query(query: str) -> str:
+    """ Collapse case and whitespace so trivially different queries share cache entries. """
+    return " ".join(query.lower().split())
 
 
-def RecallKnowledge(query, top_k=5, max_distance=0.9):
-    faiss_index = get_faiss()
-    if faiss_index is None or faiss_index.ntotal == 0:
-        logger.error("FAISS INDEX DOES NOT EXIST")
-        return []
+def embed_queries(queries):
+    """
+    Embed queries in one batched call, reusing embeddings of normalized-identical earlier queries.
+    :return: (n, dim) array
+    """
+    keys = [normalize_query(query) for query in queries]
+    embedded = {key: query_embedding_cache.get(key) for key in set(keys)}
 
-    # load metadata
-    metadata = load_metadata()
-    if not metadata:
-        logger.error("METADATA IS EMPTY OR DOES NOT EXIST")
-        return []
+    missing = {}
+    for key, query in zip(keys, queries):
+        if embedded[key] is None:
+            missing.setdefault(key, query)
 
-    # Cap top_k to the actual number of vectors in the index
-    top_k = min(top_k, faiss_index.ntotal)
+    if missing:
+        vectors, dim = embed_batch(list(missing.values()), priority=QUERY)
+        for key, vector in zip(missing, vectors):
+            vector = vector.reshape(1, -1)
+            query_embedding_cache.put(key, vector)
+            embedded[key] = vector
 
-    # embed query
-    embedded_query, dim = embed_content(query)
+    return np.vstack([embedded[key] for key in keys])
 
-    # Search
-    distances, indices = faiss_index.search(embedded_query, top_k)
 
-    # get results
-    results = []
-    for rank, (idx, dist) in enumerate(zip(indices[0], distances[0])):
-        if idx < 0:
+def embed_query(query):
+    """
+    Embed a query, reusing the embedding of a normalized-identical earlier query.
+    :return: (1, dim) array
+    """
+    return embed_queries([query])
+
+
+def knowledge_generation(shards=None) -> tuple:
+    """
+    :param shards: shard names, every shard if None
+    :return: (shard name, generation) of each shard, changes whenever one of their indexes is saved
+    """
+    stores = [get_knowledge_store(shard) for shard in (list_shards() if shards is None else shards)]
+    for store in stores:
+        store.refresh()
+    return tuple((store.shard.name, store.generation) for store in stores)
+
+
+def recall_cache_stats() -> dict:
+    """ :return: hit rate counters of the recall caches """
+    return {
+        "query_embeddings": query_embedding_cache.stats(),
+        "results": recall_result_cache.stats(),
+    }
+
+
+def _get_search_pool():
+    global _search_pool
+    if _search_pool is None:
+        _search_pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="shard-search")
+    return _search_pool
+
+
+def search_shards(stores, vectors, top_k, filters=None):
+    """
+    Search every shard and merge the hits into one global top_k per query.
+    :param stores: KnowledgeStores to search
+    :param vectors: (n, dim) query array
+    :param filters: normalized recall filters applied inside each index
+    :return: (distances, indices, shard positions), each (n, top_k), or None if every shard is empty
+    """
+    if len(stores) == 1:
+        found = [stores[0].search(vectors, top_k, filters)]
+    else:
+        found = list(_get_search_pool().map(lambda store: store.search(vectors, top_k, filters), stores))
+
+    all_distances, all_indices, all_shards = [], [], []
+    for position, result in enumerate(found):
+        if result is None:
             continue
-        if dist > max_distance:
+        distances, indices = result
+        # pad shards holding fewer than top_k vectors so the hits line up
+        pad = top_k - distances.shape[1]
+        if pad:
+            distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+            indices = np.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+        all_distances.append(distances)
+        all_indices.append(indices)
+        all_shards.append(np.full(indices.shape, position))
+
+    if not all_distances:
+        return None
+    if len(all_distances) == 1:
+        return all_distances[0], all_indices[0], all_shards[0]
+
+    distances = np.hstack(all_distances)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :top_k]
+    return (
+        np.take_along_axis(distances, order, axis=1),
+        np.take_along_axis(np.hstack(all_indices), order, axis=1),
+        np.take_along_axis(np.hstack(all_shards), order, axis=1),
+    )
+
+
+def search_lexical_shards(stores, query, top_k, filters=None, match_all=False):
+    """
+    BM25 search of every shard, merged by score.
+    :param match_all: only return chunks containing every query term
+    :return: list of (shard position, faiss_index, score), best first
+    """
+    hits = [
+        (position, faiss_index, score)
+        for position, store in enumerate(stores)
+        for faiss_index, score in store.search_lexical(query, top_k, match_all, filters)
+    ]
+    hits.sort(key=lambda hit: hit[2], reverse=True)
+    return hits[:top_k]
+
+
+def search_lexical_complete(stores, query, top_k, filters=None):
+    """ :return: set of (shard position, faiss_index) containing every term of a query with enough terms """
+    if len(lexical_terms(query)) < LEXICAL_MIN_TERMS:
+        return set()
+    return {(hit[0], hit[1]) for hit in search_lexical_shards(stores, query, top_k, filters, match_all=True)}
+
+
+def is_lexical_decisive(hits, complete) -> bool:
+    """
+    :param hits: BM25 hits of the query, best first
+    :param complete: hit keys containing every query term, see search_lexical_complete
+    :return: True if the best BM25 hit is clear enough to answer without the dense search
+    """
+    if LEXICAL_FAST_PATH_RATIO is None or not hits or (hits[0][0], hits[0][1]) not in complete:
+        return False
+    runner_up = hits[1][2] if len(hits) > 1 else 0.0
+    return hits[0][2] >= LEXICAL_FAST_PATH_RATIO * runner_up
+
+
+def fuse_rankings(rankings, top_k):
+    """
+    Reciprocal rank fusion, score = sum of 1 / (RRF_K + rank) over the rankings a hit is in.
+    :param rankings: lists of hit keys, best first
+    :return: list of (key, score), best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+def candidate_vectors(stores, keys):
+    """
+    :param keys: (shard position, faiss_index) hit keys
+    :return: (vectors, present), (n, dim) stored vectors in the order of keys, one embeddings.npy
+        read per shard, and a bool array that is False for lexical hits newer than the mapped rows
+    """
+    keys = np.asarray(keys, dtype="int64").reshape(-1, 2)
+    present = np.zeros(len(keys), dtype=bool)
+    vectors = None
+    for store_position in np.unique(keys[:, 0]):
+        store = stores[store_position]
+        rows = np.flatnonzero(keys[:, 0] == store_position)
+        rows = rows[store.has_vectors(keys[rows, 1])]
+        if not len(rows):
             continue
-        if idx >= len(metadata):
-            continue  # safety guard
-
-        results.append({
-            "rank": rank + 1,
-            "distance": float(dist),
-            "faiss_index": idx,
-            "chunk_index": metadata[idx]["chunk_index"],
-            "content": metadata[idx]["content"],
-        })
-
-    return results
+        found = store.get_vectors(keys[rows, 1])
+        if vectors is None:
+            vectors = np.zeros((len(keys), found.shape[1]), dtype="float32")
+        vectors[rows] = found
+        present[rows] = True
+    return vectors, present
+
+
+def mmr_rerank(query_vector, vectors, top_k, mmr_lambda):
+    """
+    Maximal marginal relevance, pick the candidate maximising
+    mmr_lambda * sim(query, c) - (1 - mmr_lambda) * max sim(c, already picked), cosine similarity.
+    :param query_vector: (dim,) query embedding
+    :param vectors: (n, dim) candidate embeddings, best candidate first
+    :param mmr_lambda: 1 keeps the relevance order, lower values favour diversity
+    :return: candidate positions in pick order
+    """
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+    relevance = vectors @ query_vector
+    similarity = vectors @ vectors.T
+
+    picked = []
+    redundancy = np.zeros(len(vectors), dtype="float32")
+    available = np.ones(len(vectors), dtype=bool)
+    for _ in range(min(top_k, len(vectors))):
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return picked
+
+
+def RecallKnowledge(query, top_k=5, max_distance=0.9, shards=None, hybrid=HYBRID_RECALL, filters=None,
+                    mmr_lambda=None):
+    return RecallKnowledgeBatch([query], top_k, max_distance, shards, hybrid, filters, mmr_lambda)[0]
+
+
+def RecallKnowledgeBatch(queries, top_k=5, max_distance=0.9, shards=None, hybrid=HYBRID_RECALL, filters=None,
+                         mmr_lambda=None):
+    """
+    Recall knowledge for many queries with one embedding call and one search per shard.
+    :param queries: list of query strings
+    :param top_k: number of neighbours per query
+    :param max_distance: dense hits further away than this are dropped
+    :param shards: shard names to search, every shard if None
+    :param hybrid: fuse the dense hits with BM25 hits, and answer decisive lexical queries without embedding
+    :param filters: restrict recall by "source", "namespace", "ingested_after" or "ingested_before",
+        applied inside the index so a filtered query still gets a full top_k
+    :param mmr_lambda: rerank MMR_FETCH_FACTOR * top_k candidates for diversity with maximal marginal
+        relevance using their stored vectors, None keeps the relevance order
+    :return: list of result lists, one per query
+    """
+    filters = normalize_filters(filters)
+    stores = [get_knowledge_store(shard) for shard in (list_shards() if shards is None else shards)]
+    for store in stores:
+        store.refresh()
+    stores = [store for store in stores if store.ntotal > 0]
+    if not stores:
+        logger.error("FAISS INDEX DOES NOT EXIST")
+        return [[] for _ in queries]
+
+    # reuse the results of identical queries against the same index generations
+    generations = tuple((store.shard.name, store.generation) for store in stores)
+    all_results = []
+    pending = []
+    for query in queries:
+        cache_key = (normalize_query(query), top_k, max_distance, hybrid, filters, mmr_lambda, generations)
+        cached = recall_result_cache.get(cache_key)
+        all_results.append(None if cached is None else [dict(item) for item in cached])
+        if cached is None:
+            pending.append((len(all_results) - 1, cache_key))
+
+    if not pending:
+        return all_results
+
+    # MMR picks top_k out of a larger candidate pool
+    fetch_k = top_k if mmr_lambda is None else top_k * MMR_FETCH_FACTOR
+
+    # lexical hits, queries with a decisive one skip the embedding call unless MMR needs it
+    lexical, complete = {}, {}
+    to_embed = pending
+    if hybrid:
+        for position, _ in pending:
+            lexical[position] = search_lexical_shards(stores, queries[position], fetch_k, filters)
+            complete[position] = search_lexical_complete(stores, queries[position], fetch_k, filters)
+        if mmr_lambda is None:
+            to_embed = [
+                (position, cache_key) for position, cache_key in pending
+                if not is_lexical_decisive(lexical[position], complete[position])
+            ]
+        if len(to_embed) < len(pending):
+            logger.debug(f"Answered {len(pending) - len(to_embed)} queries from the lexical index")
+
+    # embed the remaining queries and search every shard, top_k is capped to the number of vectors in each index
+    dense = {}
+    query_vectors = {}
+    if to_embed:
+        embedded_queries = embed_queries([queries[position] for position, _ in to_embed])
+        query_vectors = {position: embedded_queries[row] for row, (position, _) in enumerate(to_embed)}
+        found = search_shards(stores, embedded_queries, fetch_k, filters)
+        if found is not None:
+            distances, indices, shard_positions = found
+            keep = (indices >= 0) & (distances <= max_distance)
+            for row, (position, _) in enumerate(to_embed):
+                dense[position] = {
+                    (int(shard_positions[row, rank]), int(indices[row, rank])): float(distances[row, rank])
+                    for rank in np.flatnonzero(keep[row])
+                }
+
+    # BM25 ranks boost dense hits, but only complete matches are recalled on BM25 alone
+    fused = {}
+    for position, _ in pending:
+        rankings = [list(dense.get(position, {})), [(hit[0], hit[1]) for hit in lexical.get(position, [])]]
+        relevant = dense.get(position, {}).keys() | complete.get(position, set())
+        ranked = fuse_rankings(rankings, sum(len(ranking) for ranking in rankings))
+        fused[position] = [(key, score) for key, score in ranked if key in relevant][:fetch_k]
+
+    # rerank the candidates against each other with the vectors already in embeddings.npy
+    if mmr_lambda is not None:
+        for position, hits in fused.items():
+            if len(hits) > 1:
+                vectors, present = candidate_vectors(stores, [key for key, _ in hits])
+                # a candidate without a vector cannot be compared, leave it out
+                hits = [hit for hit, keep in zip(hits, present) if keep]
+                if len(hits) > 1:
+                    vectors = vectors[present]
+                    hits = [hits[pick] for pick in mmr_rerank(query_vectors[position], vectors, top_k, mmr_lambda)]
+            fused[position] = hits[:top_k]
+
+    # fetch metadata for the surviving hits only, one lookup per shard
+    wanted = {}
+    for hits in fused.values():
+        for (store_position, idx), _ in hits:
+            wanted.setdefault(store_position, set()).add(idx)
+    metadata = {position: stores[position].get_metadata(ids) for position, ids in wanted.items()}
+    if wanted and not any(metadata.values()):
+        logger.error("METADATA IS EMPTY OR DOES NOT EXIST")
+
+    # get results
+    for position, cache_key in pending:
+        results = []
+        for (store_position, idx), score in fused[position]:
+            shard_metadata = metadata[store_position]
+            if idx not in shard_metadata:
+                continue  # safety guard
+
+            results.append({
+                "rank": len(results) + 1,
+                "distance": dense.get(position, {}).get((store_position, idx)),
+                "score": score,
+                "shard": stores[store_position].shard.name,
+                "faiss_index": idx,
+                "chunk_index": shard_metadata[idx]["chunk_index"],
+                "source": shard_metadata[idx]["source"],
+                "content": shard_metadata[idx]["content"],
+            })
+
+        recall_result_cache.put(cache_key, [dict(item) for item in results])
+        all_results[position] = results
+
+    return all_results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,137 @@
+import re
+
+from utility_scripts.system_logging import setup_logger
+from utility_scripts.token_counter import count_tokens
+
+# configure logging
+logger = setup_logger(__name__)
+
+CONTEXT_TOKENS = 3072       # budget for the retrieved context of one turn
+MIN_PARTIAL_TOKENS = 64     # smallest remainder worth filling with part of a chunk
+HEADING_MAX_CHARS = 120     # longer lines without end punctuation are still treated as text
+MIN_SENTENCE_CHARS = 24     # shorter pieces, such as "St." or "No. 3", stay with the text that follows them
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+LIST_ITEM = re.compile(r"^([-*+•]|\d+[.)])\s")
+
+
+def normalize_span(text: str) -> str:
+    """ Collapse case and whitespace so repeated text is recognised. """
+    return " ".join(text.lower().split())
+
+
+def is_heading(line: str) -> bool:
+    """ Contextualized chunks start with their heading path, one short line per heading. """
+    return len(line) <= HEADING_MAX_CHARS and not LIST_ITEM.match(line) \
+        and not line.endswith((".", "!", "?", ":", ";", ","))
+
+
+def split_sentences(line: str) -> list:
+    """ Split a line at sentence ends, keeping short pieces such as abbreviations with the text after them. """
+    sentences, pending = [], ""
+    for piece in SENTENCE_END.split(line):
+        pending = f"{pending} {piece}" if pending else piece
+        if len(pending) >= MIN_SENTENCE_CHARS:
+            sentences.append(pending)
+            pending = ""
+    if pending:
+        if sentences:
+            sentences[-1] = f"{sentences[-1]} {pending}"
+        else:
+            sentences.append(pending)
+    return sentences
+
+
+def split_chunk(content: str) -> tuple:
+    """
+    Split a chunk into its heading path and the sentences of its text.
+    :return: (heading path tuple, list of (line number, sentence))
+    """
+    lines = [line.strip() for line in content.splitlines() if line.strip()]
+    start = 0
+    while start < len(lines) and is_heading(lines[start]):
+        start += 1
+
+    # a chunk that is nothing but short lines has no path, only text
+    if start == len(lines):
+        start = 0
+
+    sentences = [
+        (number, sentence)
+        for number, line in enumerate(lines[start:])
+        for sentence in split_sentences(line)
+        if sentence.strip()
+    ]
+    return tuple(lines[:start]), sentences
+
+
+def render_block(path, sentences) -> str:
+    """ :return: the heading path followed by the sentences, on their original lines """
+    lines = {}
+    for number, sentence in sentences:
+        lines.setdefault(number, []).append(sentence)
+    return "\n".join(list(path) + [" ".join(line) for line in lines.values()])
+
+
+def assemble_context(results, max_tokens=CONTEXT_TOKENS) -> str:
+    """
+    Turn recall results into the context of a prompt.
+    Sentences an adjacent chunk of the same source already gave are left out, which drops
+    the overlap the chunker adds, and a heading path is only repeated when it differs from
+    the block above. The highest ranked chunks are packed into max_tokens, the first one
+    that does not fit is cut at a sentence boundary.
+    :param results: RecallKnowledge results, best first
+    :param max_tokens: token budget of the context
+    :return: context text
+    """
+    seen = {}       # (shard, source, chunk_index) -> sentences that chunk gave
+    blocks = []
+    previous_path = None
+    used = 0
+    raw = 0
+    for item in results:
+        raw += count_tokens(item["content"])
+        path, sentences = split_chunk(item["content"])
+
+        chunk = (item.get("shard"), item.get("source"), item.get("chunk_index"))
+        given = set()
+        if chunk[2] is not None:
+            for neighbour in (chunk[2] - 1, chunk[2] + 1):
+                given |= seen.get(chunk[:2] + (neighbour,), set())
+
+        fresh, keys = [], set()
+        for number, sentence in sentences:
+            key = normalize_span(sentence)
+            if key not in given and key not in keys:
+                keys.add(key)
+                fresh.append((number, sentence))
+        if not fresh:
+            continue
+
+        shown_path = () if path == previous_path else path
+        block = render_block(shown_path, fresh)
+        tokens = count_tokens(block)
+        truncated = used + tokens > max_tokens
+        if truncated:
+            # fill what is left with the start of the chunk, then stop
+            if blocks and max_tokens - used < MIN_PARTIAL_TOKENS:
+                break
+            count = 0
+            while count < len(fresh) and count_tokens(render_block(shown_path, fresh[:count + 1])) <= max_tokens - used:
+                count += 1
+            if not count:
+                break
+            fresh = fresh[:count]
+            block = render_block(shown_path, fresh)
+            tokens = count_tokens(block)
+
+        blocks.append(block)
+        used += tokens
+        if chunk[2] is not None:
+            seen[chunk] = seen.get(chunk, set()) | keys
+        previous_path = path
+        if truncated:
+            break
+
+    logger.debug(f"Assembled context of {used} tokens from {raw} retrieved")
+    return "\n\n".join(blocks)
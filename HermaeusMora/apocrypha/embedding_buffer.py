@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+
+class EmbeddingBuffer:
+    """
+    Growable embedding matrix backed by a memory-mapped .npy file.
+
+    Rows are written in place into spare capacity at the end of the file, which
+    doubles when it runs out, so appending never copies the existing matrix.
+    The .npy header always records the number of flushed rows, so the file stays
+    readable by np.load while spare capacity is still attached.
+    """
+
+    def __init__(self, path, dtype="float32", initial_capacity=1024):
+        self.path = str(path)
+        self.dtype = np.dtype(dtype)
+        self.initial_capacity = max(1, initial_capacity)
+        self.dim = None
+        self.count = 0
+        self.capacity = 0
+        self._offset = 0
+        self._version = (1, 0)
+        self._mmap = None
+
+        if os.path.exists(self.path):
+            self._open_existing()
+
+    # -------------------
+    # File handling
+    # -------------------
+    def _open_existing(self):
+        with open(self.path, "rb") as f:
+            self._version = np.lib.format.read_magic(f)
+            if self._version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            self._offset = f.tell()
+
+        if fortran_order:
+            raise ValueError(f"{self.path} is stored in Fortran order and cannot be appended to")
+
+        # legacy empty cache saved as a (0, 0) array
+        if len(shape) != 2 or shape[1] == 0:
+            return
+
+        self.dtype = dtype
+        self.dim = shape[1]
+        self.count = shape[0]
+        self.capacity = (os.path.getsize(self.path) - self._offset) // self._row_bytes
+        self._open_map()
+
+    def _create(self, dim):
+        self.dim = dim
+        self._version = (1, 0)
+        with open(self.path, "wb") as f:
+            self._write_header(f, 0)
+            self._offset = f.tell()
+
+    @property
+    def _row_bytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def _write_header(self, f, rows):
+        header = {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (rows, self.dim),
+        }
+        f.seek(0)
+        if self._version == (1, 0):
+            np.lib.format.write_array_header_1_0(f, header)
+        else:
+            np.lib.format.write_array_header_2_0(f, header)
+
+        # numpy pads the header so the row count can change without moving the data
+        if self._offset and f.tell() != self._offset:
+            raise RuntimeError(f"Header of {self.path} changed size, refusing to overwrite data")
+
+    def _open_map(self):
+        self._mmap = None
+        if self.capacity > 0:
+            self._mmap = np.memmap(
+                self.path, dtype=self.dtype, mode="r+", offset=self._offset, shape=(self.capacity, self.dim)
+            )
+
+    def _grow(self, min_capacity):
+        new_capacity = max(min_capacity, self.capacity * 2, self.initial_capacity)
+        if self._mmap is not None:
+            self._mmap.flush()
+
+        with open(self.path, "r+b") as f:
+            f.truncate(self._offset + new_capacity * self._row_bytes)
+
+        self.capacity = new_capacity
+        self._open_map()
+
+    # -------------------
+    # Public API
+    # -------------------
+    def append(self, vectors):
+        """
+        Append vectors to the end of the buffer.
+        :param vectors: (n, dim) array
+        :return: row index of the first appended vector
+        """
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+
+        if self.dim is None:
+            self._create(vectors.shape[1])
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension mismatch: {vectors.shape[1]} != {self.dim}")
+
+        first_row = self.count
+        needed = self.count + vectors.shape[0]
+        if needed > self.capacity:
+            self._grow(needed)
+
+        self._mmap[first_row:needed] = vectors
+        self.count = needed
+        return first_row
+
+    def flush(self):
+        """ Write appended rows to disk and record them in the .npy header. """
+        if self.dim is None:
+            return
+        if self._mmap is not None:
+            self._mmap.flush()
+        with open(self.path, "r+b") as f:
+            self._write_header(f, self.count)
+
+    def close(self):
+        """ Flush and release the spare capacity at the end of the file. """
+        if self.dim is None:
+            return
+        self.flush()
+        self._mmap = None
+        with open(self.path, "r+b") as f:
+            f.truncate(self._offset + self.count * self._row_bytes)
+        self.capacity = self.count
+        logger.debug(f"Closed embeddings buffer with {self.count} rows")
+
+    @property
+    def array(self):
+        """ Read view of the stored rows. Do not keep it across appends. """
+        if self._mmap is None:
+            return np.empty((0, self.dim or 0), dtype=self.dtype)
+        return self._mmap[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,152 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache keyed by (model, content sha256).
+
+    Vectors are stored as raw little-endian float32 or float16 blobs, the
+    precision is recorded per row so both can be read back. When the stored
+    vectors exceed max_bytes, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, dtype="float32"):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            "model TEXT NOT NULL, "
+            "hash TEXT NOT NULL, "
+            "vector BLOB NOT NULL, "
+            "last_used INTEGER NOT NULL, "
+            "PRIMARY KEY (model, hash)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS vectors_last_used ON vectors (last_used)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(vectors)")]
+        if "dtype" not in columns:
+            self._db.execute("ALTER TABLE vectors ADD COLUMN dtype TEXT NOT NULL DEFAULT '<f4'")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors").fetchone()[0]
+
+    def get_many(self, model, hashes):
+        """
+        Look up cached embeddings.
+        :param model: embedding model name
+        :param hashes: content hashes to look up
+        :return: dict of hash -> float32 vector for the hashes that were cached
+        """
+        hashes = list(set(hashes))
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(
+                    f"SELECT hash, vector, dtype FROM vectors WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for hash_content, blob, dtype in rows:
+                    found[hash_content] = np.frombuffer(blob, dtype=dtype).astype("float32")
+
+            if found:
+                now = time.time_ns()
+                self._db.executemany(
+                    "UPDATE vectors SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, hash_content) for hash_content in found],
+                )
+                self._db.commit()
+
+            self.hits += len(found)
+            self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, model, items):
+        """
+        Store embeddings, evicting old entries if the cache grows past max_bytes.
+        :param model: embedding model name
+        :param items: dict of hash -> vector
+        """
+        if not items:
+            return
+        now = time.time_ns()
+        rows = [
+            (model, hash_content, np.asarray(vector, dtype=self.dtype).tobytes(), now, self.dtype.str)
+            for hash_content, vector in items.items()
+        ]
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO vectors (model, hash, vector, last_used, dtype) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._db.commit()
+            self._size += sum(len(row[2]) for row in rows)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """ Drop least recently used entries until the cache is 10% under max_bytes. """
+        self._size = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        if self._size <= target:
+            return
+
+        removed = 0
+        rows = self._db.execute("SELECT model, hash, LENGTH(vector) FROM vectors ORDER BY last_used")
+        doomed = []
+        for model, hash_content, size in rows:
+            if self._size - removed <= target:
+                break
+            doomed.append((model, hash_content))
+            removed += size
+        rows.close()
+
+        self._db.executemany("DELETE FROM vectors WHERE model = ? AND hash = ?", doomed)
+        self._db.commit()
+        self._size -= removed
+        logger.debug(f"Evicted {len(doomed)} cached embeddings")
+
+    def convert(self, dtype):
+        """
+        Re-encode every stored vector with a new precision.
+        :param dtype: "float32" or "float16"
+        """
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT model, hash, vector, dtype FROM vectors WHERE dtype != ?", (self.dtype.str,)
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE vectors SET vector = ?, dtype = ? WHERE model = ? AND hash = ?",
+                [
+                    (np.frombuffer(blob, dtype=old).astype(self.dtype).tobytes(), self.dtype.str, model, hash_content)
+                    for model, hash_content, blob, old in rows
+                ],
+            )
+            self._db.commit()
+            self._size = self._db.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM vectors").fetchone()[0]
+        logger.info(f"Converted {len(rows)} cached embeddings to {dtype}")
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bytes": self._size,
+        }
@@ -0,0 +1,192 @@
+import threading
+
+import faiss
+import numpy as np
+
+from apocrypha.vector_database import get_faiss, get_generation, get_metadata, get_shard, search_lexical, \
+    filter_ids, normalize_filters, is_exhaustive, search_parameters, get_index_ids, has_native_ids, \
+    FAISS_MMAP, FILTER_EXACT_MAX
+from utility_scripts.lru_cache import LRUCache
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+
+class KnowledgeStore:
+    """
+    Keeps the FAISS index of one shard resident between recalls.
+
+    The index is only read from disk again when the generation stamp written by
+    save_faiss changes, so a query costs a stat-sized file read plus the search.
+    With FAISS_MMAP the index is mapped read-only, so startup only touches the
+    pages a search needs and several processes share one page-cached copy.
+    Metadata rows are cached as they are hit and dropped on reload.
+
+    Filtered searches restrict FAISS with an ID bitmap. A bitmap is kept per filter
+    clause (one source list, one namespace list, one date range) and clauses are
+    combined with AND, so repeated filters cost no metadata query until the next reload.
+    Metadata runs ahead of the loaded generation while an ingestion is writing, so the
+    combined bitmap is limited to the chunk IDs the loaded index holds.
+    """
+
+    def __init__(self, shard=None):
+        self.shard = get_shard(shard)
+        self.index = None
+        self.generation = None
+        self._rows = {}
+        self._bitmaps = LRUCache(max_entries=64)
+        self._loaded = None
+        self._embeddings = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """
+        Reload the index if the on-disk generation changed.
+        :return: True if a reload happened
+        """
+        generation = get_generation(self.shard)
+        if generation == self.generation and self.index is not None:
+            return False
+
+        with self._lock:
+            if generation == self.generation and self.index is not None:
+                return False
+            self.index = get_faiss(mmap=FAISS_MMAP, shard=self.shard)
+            self._rows = {}
+            self._bitmaps.clear()
+            self._loaded = None
+            self._embeddings = None
+            self.generation = generation
+
+        if self.index is not None:
+            logger.info(f"Loaded {self.shard.name} generation {generation} ({self.index.ntotal} vectors)")
+        return True
+
+    @property
+    def ntotal(self) -> int:
+        return 0 if self.index is None else self.index.ntotal
+
+    def search(self, vectors, top_k, filters=None):
+        """
+        Search the resident index.
+        :param vectors: (n, dim) query array
+        :param top_k: number of neighbours per query, capped to the index size
+        :param filters: recall filters, see normalize_filters
+        :return: (distances, indices) or None if the index is empty or nothing matches the filters
+        """
+        self.refresh()
+        index = self.index
+        if index is None or index.ntotal == 0:
+            return None
+        if not filters:
+            return index.search(vectors, min(top_k, index.ntotal))
+
+        bitmap = self.filter_bitmap(filters)
+        ids = np.flatnonzero(bitmap)
+        if len(ids) == 0:
+            return None
+        top_k = min(top_k, len(ids))
+
+        # graph and IVF searches can miss a small selection, compare against its vectors directly
+        if len(ids) <= FILTER_EXACT_MAX and not is_exhaustive(index):
+            return self._search_exact(vectors, ids, top_k)
+
+        packed = np.packbits(bitmap, bitorder="little")
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(packed))
+        return index.search(vectors, top_k, params=search_parameters(index, selector))
+
+    def get_vectors(self, faiss_indices):
+        """
+        Read stored vectors from the memory-mapped embeddings.npy, no re-embedding needed.
+        :return: (n, dim) float32 array in the order of faiss_indices
+        """
+        return np.ascontiguousarray(self._get_embeddings()[np.asarray(faiss_indices, dtype="int64")], dtype="float32")
+
+    def has_vectors(self, faiss_indices):
+        """
+        Chunks recalled from live metadata can be newer than the mapped embeddings.npy.
+        :return: bool array, True where get_vectors can read the chunk's vector
+        """
+        faiss_indices = np.asarray(faiss_indices, dtype="int64")
+        return (faiss_indices >= 0) & (faiss_indices < len(self._get_embeddings()))
+
+    def _get_embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = np.load(self.shard.embeddings_path, mmap_mode="r")
+        return self._embeddings
+
+    def loaded_bitmap(self):
+        """ :return: bool array indexed by chunk ID, True for the chunks in the loaded index """
+        index = self.index
+        if self._loaded is None and index is not None:
+            if isinstance(index, faiss.IndexIDMap) or has_native_ids(index):
+                ids = get_index_ids(index)
+            else:
+                ids = np.arange(index.ntotal)
+            loaded = np.zeros(ids.max() + 1 if len(ids) else 0, dtype=bool)
+            loaded[ids] = True
+            self._loaded = loaded
+        return self._loaded
+
+    def _search_exact(self, vectors, ids, top_k):
+        """ Brute-force L2 search over the embeddings rows of the given chunk IDs """
+        candidates = self.get_vectors(ids)
+        distances, positions = faiss.knn(np.ascontiguousarray(vectors, dtype="float32"), candidates, top_k)
+        return distances, ids[positions]
+
+    def filter_bitmap(self, filters):
+        """
+        :param filters: recall filters, see normalize_filters
+        :return: bool array indexed by chunk ID, True where every clause matches a chunk of the loaded index
+        """
+        bitmap = None
+        for clause in normalize_filters(filters):
+            mask = self._bitmaps.get(clause)
+            if mask is None:
+                ids = filter_ids((clause,), self.shard)
+                mask = np.zeros(ids[-1] + 1 if len(ids) else 0, dtype=bool)
+                mask[ids] = True
+                self._bitmaps.put(clause, mask)
+
+            if bitmap is None:
+                bitmap = mask
+            else:
+                size = min(len(bitmap), len(mask))
+                bitmap = bitmap[:size] & mask[:size]
+
+        loaded = self.loaded_bitmap()
+        size = min(len(bitmap), len(loaded))
+        return bitmap[:size] & loaded[:size]
+
+    def search_lexical(self, query, top_k, match_all=False, filters=None):
+        """
+        Rank the shard's chunks by BM25 over the terms of a query.
+        :return: list of (faiss_index, score), best first
+        """
+        return search_lexical(query, top_k, self.shard, match_all, filters)
+
+    def get_metadata(self, faiss_indices):
+        """
+        Fetch metadata rows, reading only the ones not already cached.
+        :return: dict of faiss_index -> metadata entry
+        """
+        faiss_indices = [int(idx) for idx in faiss_indices if idx >= 0]
+        rows = self._rows
+        missing = [idx for idx in faiss_indices if idx not in rows]
+        if missing:
+            rows.update(get_metadata(missing, self.shard))
+        return {idx: rows[idx] for idx in faiss_indices if idx in rows}
+
+
+_knowledge_stores = {}
+_knowledge_stores_lock = threading.Lock()
+
+
+def get_knowledge_store(shard=None) -> KnowledgeStore:
+    """ :return: the process wide KnowledgeStore of a shard """
+    shard = get_shard(shard)
+    with _knowledge_stores_lock:
+        if shard.name not in _knowledge_stores:
+            _knowledge_stores[shard.name] = KnowledgeStore(shard)
+        return _knowledge_stores[shard.name]
@@ -0,0 +1,370 @@
+import argparse
+import os
+import sqlite3
+
+import faiss
+import numpy as np
+
+from apocrypha.embedding_buffer import EmbeddingBuffer
+from apocrypha.vector_database import build_faiss_index, describe_index, evaluate_recall, get_embeddings_path, \
+    get_faiss, save_faiss, get_embedding_cache, load_live_ids, load_chunk_hashes, get_metadata, get_metadata_db, \
+    get_index_ids, has_native_ids, get_shard, content_hash, recover_store, staged_path, finish_compaction, \
+    EMBEDDING_MODEL, INDEX_TYPES, INDEX_ADD_BLOCK
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+# Largest relative error between a reconstructed index vector and its embeddings row,
+# ivfpq is lossy by design and is not checked
+RECONSTRUCTION_TOLERANCE = {"flat": 1e-3, "hnsw": 1e-3, "ivf": 1e-3, "sq_fp16": 1e-2, "sq8": 5e-2}
+
+# Share of sampled vectors that must find their own chunk ID among their SELF_HIT_K nearest neighbours
+SELF_HIT_K = 10
+SELF_HIT_MIN = 0.9
+
+
+def rebuild_index(index_type="auto", k=10, sample_size=1000, dry_run=False, shard=None):
+    """
+    Rebuild faiss.bin from embeddings.npy with the requested index type.
+    :param index_type: one of INDEX_TYPES or "auto"
+    :param k: k used for the recall@k report
+    :param sample_size: number of stored vectors used as evaluation queries
+    :param dry_run: build and evaluate without replacing faiss.bin
+    :param shard: shard to rebuild, the default shard if None
+    :return: dict report
+    """
+    embeddings_path = get_embeddings_path(shard)
+    if not os.path.exists(embeddings_path):
+        logger.error("No embeddings to rebuild from")
+        return None
+
+    embeddings = np.load(embeddings_path, mmap_mode="r")
+    live_ids = load_live_ids(shard)
+    current = get_faiss(shard=shard)
+    index = build_faiss_index(embeddings, index_type, live_ids)
+
+    report = {
+        "previous_type": None if current is None else describe_index(current),
+        "index_type": describe_index(index),
+        "ntotal": index.ntotal,
+        f"recall@{k}": evaluate_recall(index, embeddings, live_ids, k, sample_size),
+    }
+    logger.info(f"Rebuilt index: {report}")
+
+    if not dry_run:
+        save_faiss(index, shard)
+    return report
+
+
+def convert_embeddings(dtype, shard=None):
+    """
+    Rewrite embeddings.npy with a new precision, block by block.
+    :param dtype: "float32" or "float16"
+    :param shard: shard to convert, the default shard if None
+    :return: (bytes before, bytes after)
+    """
+    embeddings_path = get_embeddings_path(shard)
+    embeddings = np.load(embeddings_path, mmap_mode="r")
+    before = os.path.getsize(embeddings_path)
+    if embeddings.dtype == np.dtype(dtype):
+        logger.info(f"Embeddings are already {dtype}")
+        return before, before
+
+    tmp_path = embeddings_path.with_name(f"{embeddings_path.stem}.tmp.npy")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    with EmbeddingBuffer(tmp_path, dtype=dtype, initial_capacity=embeddings.shape[0] or 1) as converted:
+        for start in range(0, embeddings.shape[0], INDEX_ADD_BLOCK):
+            converted.append(embeddings[start:start + INDEX_ADD_BLOCK])
+
+    del embeddings
+    os.replace(tmp_path, embeddings_path)
+    after = os.path.getsize(embeddings_path)
+    logger.info(f"Converted embeddings to {dtype}: {before} -> {after} bytes")
+    return before, after
+
+
+def migrate_store(dtype=None, index_type=None, k=10, sample_size=1000, shard=None):
+    """
+    Convert an existing store to a compressed representation.
+    :param dtype: new precision for embeddings.npy and the embedding cache, None to keep
+    :param index_type: new index type such as "sq8" or "ivfpq", None to keep
+    :param shard: shard to convert, the default shard if None. The embedding cache is shared by every shard.
+    :return: dict report
+    """
+    report = {}
+    if dtype is not None:
+        if os.path.exists(get_embeddings_path(shard)):
+            report["embeddings_bytes"] = convert_embeddings(dtype, shard)
+        get_embedding_cache().convert(dtype)
+        report["embedding_cache_bytes"] = get_embedding_cache().stats()["bytes"]
+
+    if index_type is not None:
+        report["index"] = rebuild_index(index_type, k, sample_size, shard=shard)
+
+    logger.info(f"Migration finished: {report}")
+    return report
+
+
+def source_keys(hashes, sources):
+    """ :return: array of "source hash" keys, equal for copies of the same content within one source """
+    return np.array([f"{source}\n{hash_content}" for source, hash_content in zip(sources, hashes)], dtype=object)
+
+
+def verify_store(shard=None, sample_size=1000):
+    """
+    Check that embeddings.npy, faiss.bin and metadata.db describe the same chunks.
+    Compares row counts and ID sets, checks a sample of chunks against their content hash and
+    the embedding cache (hash to row mapping), and diffs vectors reconstructed from the index
+    against their embeddings rows.
+    :param shard: shard to verify, the default shard if None
+    :param sample_size: number of chunks used by the sampled checks
+    :return: dict report, report["problems"] lists every inconsistency found
+    """
+    shard = get_shard(shard)
+    problems = []
+    ids, hashes, sources = load_chunk_hashes(shard)
+    embeddings = np.load(shard.embeddings_path, mmap_mode="r") if shard.embeddings_path.exists() else None
+    rows = 0 if embeddings is None or embeddings.ndim != 2 else embeddings.shape[0]
+    index = get_faiss(shard=shard)
+    stable_ids = isinstance(index, faiss.IndexIDMap) or has_native_ids(index)
+
+    report = {"shard": shard.name, "rows": rows, "metadata": len(ids), "index_vectors": 0}
+
+    # metadata against embeddings rows
+    orphans = int(np.count_nonzero(ids >= rows))
+    if orphans:
+        problems.append(f"{orphans} metadata entries point past the last embeddings row")
+    live = ids[ids < rows]
+    report["dead_rows"] = rows - len(live)
+
+    # replace_source stores each chunk of a source once, but the same text under two sources is expected
+    _, counts = np.unique(source_keys(hashes, sources), return_counts=True)
+    report["duplicates"] = int(np.sum(counts - 1))
+    if report["duplicates"]:
+        problems.append(f"{report['duplicates']} chunks duplicate the content of another chunk of their source")
+    _, counts = np.unique(hashes, return_counts=True)
+    report["shared_content"] = int(np.sum(counts - 1)) - report["duplicates"]
+
+    # index against metadata
+    if index is not None:
+        report["index_vectors"] = index.ntotal
+        report["index_type"] = describe_index(index)
+        if embeddings is not None and rows and index.d != embeddings.shape[1]:
+            problems.append(f"Index dimension {index.d} differs from embeddings dimension {embeddings.shape[1]}")
+
+        index_ids = get_index_ids(index) if stable_ids else np.arange(index.ntotal)
+        if len(np.unique(index_ids)) != len(index_ids):
+            problems.append("Index holds the same chunk ID more than once")
+        missing = np.setdiff1d(ids, index_ids)
+        extra = np.setdiff1d(index_ids, ids)
+        if len(missing):
+            problems.append(f"{len(missing)} chunks with metadata are missing from the index")
+        if len(extra):
+            problems.append(f"{len(extra)} index vectors have no metadata")
+    elif len(ids):
+        problems.append("Metadata exists but faiss.bin is missing")
+
+    if shard.wal_path.exists() and os.path.getsize(shard.wal_path):
+        problems.append("The write-ahead log holds batches that were never recovered")
+
+    # sampled checks
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(live, min(sample_size, len(live)), replace=False)) if len(live) else live
+    if len(sample):
+        entries = get_metadata(sample, shard)
+        wrong_hash = sum(content_hash(entry["content"] or "") != entry["hash"] for entry in entries.values())
+        if wrong_hash:
+            problems.append(f"{wrong_hash} sampled chunks do not match their content hash")
+
+        # the embedding cache is keyed by content hash, so a row holding another chunk's vector shows up here
+        sample_hashes = [entries[idx]["hash"] for idx in sample.tolist()]
+        cached = get_embedding_cache().get_many(EMBEDDING_MODEL, sample_hashes)
+        checked = [position for position, hash_content in enumerate(sample_hashes) if hash_content in cached]
+        if checked:
+            expected = np.vstack([cached[sample_hashes[position]] for position in checked])
+            stored = np.asarray(embeddings[sample[checked]], dtype="float32")
+            error = np.linalg.norm(stored - expected, axis=1) / np.maximum(np.linalg.norm(expected, axis=1), 1e-12)
+            mismatched = int(np.count_nonzero(error > 1e-2))
+            report["hash_row_checked"] = len(checked)
+            if mismatched:
+                problems.append(f"{mismatched} sampled embeddings rows do not hold their chunk's vector")
+
+        present = np.intersect1d(sample, index_ids) if index is not None else sample[:0]
+        if len(present) and index.d != embeddings.shape[1]:
+            present = present[:0]
+
+        tolerance = RECONSTRUCTION_TOLERANCE.get(report.get("index_type"))
+        if len(present) and tolerance is not None and (isinstance(index, faiss.IndexIDMap2) or has_native_ids(index)):
+            ivf = faiss.try_extract_index_ivf(index)
+            if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+                ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+            reconstructed = np.vstack([index.reconstruct(int(idx)) for idx in present])
+            stored = np.asarray(embeddings[present], dtype="float32")
+            error = np.linalg.norm(reconstructed - stored, axis=1) / np.maximum(np.linalg.norm(stored, axis=1), 1e-12)
+            report["reconstruction_max_error"] = float(error.max())
+            drifted = int(np.count_nonzero(error > tolerance))
+            if drifted:
+                problems.append(f"{drifted} sampled index vectors differ from their embeddings rows")
+
+        # a stored vector must find its own chunk, an index whose IDs point at other rows fails here
+        if len(present) and stable_ids:
+            queries = np.ascontiguousarray(embeddings[present], dtype="float32")
+            _, found = index.search(queries, min(SELF_HIT_K, index.ntotal))
+            report["self_hit_rate"] = float(np.mean([idx in row for idx, row in zip(present, found)]))
+            if report["self_hit_rate"] < SELF_HIT_MIN:
+                problems.append(f"Only {report['self_hit_rate']:.0%} of sampled vectors find their own chunk in the index")
+
+    report["problems"] = problems
+    report["ok"] = not problems
+    if problems:
+        logger.warning(f"Store {shard.name} has problems: {problems}")
+    else:
+        logger.info(f"Store {shard.name} is consistent")
+    return report
+
+
+def compact_store(shard=None, index_type=None, k=10, sample_size=1000):
+    """
+    Rewrite a shard without dead rows, orphaned metadata or duplicate chunks and rebuild its index in bulk.
+    Surviving chunks are renumbered 0..n-1 in their old order, the first copy of content duplicated
+    within a source is kept, the same content under different sources is left alone.
+    The new embeddings.npy, metadata.db and faiss.bin are staged next to the live files
+    and swapped in together by finish_compaction, so readers see either generation, never a mix.
+    Run it while nothing else has the shard open.
+    :param shard: shard to compact, the default shard if None
+    :param index_type: index type to rebuild with, one of INDEX_TYPES or "auto",
+        the type of the current index if None so a compressed index stays compressed
+    :return: dict report
+    """
+    shard = get_shard(shard)
+    with shard.writing():
+        recover_store(shard)
+        if not shard.embeddings_path.exists():
+            logger.error("No embeddings to compact")
+            return None
+
+        if index_type is None:
+            current = get_faiss(shard=shard)
+            index_type = "auto" if current is None else describe_index(current)
+            del current
+
+        embeddings = np.load(shard.embeddings_path, mmap_mode="r")
+        ids, hashes, sources = load_chunk_hashes(shard)
+        in_range = ids < embeddings.shape[0]
+        ids, keys = ids[in_range], source_keys(hashes[in_range], sources[in_range])
+
+        # ids are sorted, so the first occurrence of a key is the oldest copy within its source
+        _, first = np.unique(keys, return_index=True)
+        keep = np.sort(ids[first])
+        report = {
+            "rows_before": embeddings.shape[0],
+            "rows_after": len(keep),
+            "dropped_orphans": int(np.count_nonzero(~in_range)),
+            "dropped_duplicates": len(ids) - len(keep),
+        }
+        if not len(keep):
+            logger.error("Compaction would leave the shard empty, delete it instead")
+            return None
+
+        # stage embeddings.npy with the surviving rows
+        embeddings_staged = staged_path(shard.embeddings_path)
+        if embeddings_staged.exists():
+            os.remove(embeddings_staged)
+        with EmbeddingBuffer(embeddings_staged, dtype=embeddings.dtype, initial_capacity=len(keep)) as compacted:
+            for start in range(0, len(keep), INDEX_ADD_BLOCK):
+                compacted.append(embeddings[keep[start:start + INDEX_ADD_BLOCK]])
+        del embeddings
+
+        # stage faiss.bin built from the compacted matrix
+        compacted = np.load(embeddings_staged, mmap_mode="r")
+        index = build_faiss_index(compacted, index_type)
+        report["index_type"] = describe_index(index)
+        report[f"recall@{k}"] = evaluate_recall(index, compacted, None, k, sample_size)
+        faiss.write_index(index, str(staged_path(shard.faiss_path)))
+        del compacted, index
+
+        # stage metadata.db with the surviving chunks renumbered
+        metadata_staged = staged_path(shard.metadata_db_path)
+        if metadata_staged.exists():
+            os.remove(metadata_staged)
+        with shard.metadata_lock:
+            db = get_metadata_db(shard)
+            db.execute("VACUUM INTO ?", (str(metadata_staged),))
+        _renumber_metadata(metadata_staged, keep)
+
+        # commit point, from here on recovery finishes the swap
+        with open(shard.compact_marker_path, "w") as f:
+            f.write(str(len(keep)))
+            f.flush()
+            os.fsync(f.fileno())
+        finish_compaction(shard)
+
+    report["verified"] = verify_store(shard, sample_size)["ok"]
+    logger.info(f"Compacted {shard.name}: {report}")
+    return report
+
+
+def _renumber_metadata(db_path, keep):
+    """
+    Drop every chunk not in keep and renumber the rest to their position in keep.
+    :param keep: sorted chunk IDs to keep
+    """
+    db = sqlite3.connect(db_path)
+    db.execute("CREATE TEMP TABLE keep (faiss_index INTEGER PRIMARY KEY)")
+    db.executemany("INSERT INTO keep VALUES (?)", [(int(idx),) for idx in keep])
+    db.execute("DELETE FROM chunks WHERE faiss_index NOT IN (SELECT faiss_index FROM keep)")
+
+    # every new ID is at most the old one, so renumbering in ascending order never collides
+    db.executemany(
+        "UPDATE chunks SET faiss_index = ? WHERE faiss_index = ?",
+        [(new, int(old)) for new, old in enumerate(keep) if new != old],
+    )
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone() is not None:
+        db.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+    db.commit()
+    db.execute("PRAGMA journal_mode=DELETE")
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apocrypha database maintenance")
+    parser.add_argument("--shard", default=None, help="Shard to work on, the default shard if omitted")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser("rebuild", help="Rebuild the FAISS index from embeddings.npy")
+    rebuild.add_argument("--index-type", default="auto", choices=["auto", *INDEX_TYPES])
+    rebuild.add_argument("--k", type=int, default=10, help="k for the recall@k report")
+    rebuild.add_argument("--sample", type=int, default=1000, help="Number of evaluation queries")
+    rebuild.add_argument("--dry-run", action="store_true", help="Only report, keep the current index")
+
+    migrate = commands.add_parser("migrate", help="Convert the store to compressed vectors")
+    migrate.add_argument("--dtype", choices=["float32", "float16"], help="Precision of stored embeddings")
+    migrate.add_argument("--index-type", choices=["auto", *INDEX_TYPES], help="Index type to rebuild with")
+    migrate.add_argument("--k", type=int, default=10, help="k for the recall@k report")
+    migrate.add_argument("--sample", type=int, default=1000, help="Number of evaluation queries")
+
+    verify = commands.add_parser("verify", help="Check embeddings.npy, faiss.bin and metadata.db against each other")
+    verify.add_argument("--sample", type=int, default=1000, help="Number of chunks used by the sampled checks")
+
+    compact = commands.add_parser("compact", help="Drop dead and duplicate chunks and rebuild the index")
+    compact.add_argument("--index-type", choices=["auto", *INDEX_TYPES], help="Index type, the current one if omitted")
+    compact.add_argument("--k", type=int, default=10, help="k for the recall@k report")
+    compact.add_argument("--sample", type=int, default=1000, help="Number of evaluation queries")
+
+    args = parser.parse_args()
+    if args.command == "rebuild":
+        rebuild_index(args.index_type, args.k, args.sample, args.dry_run, args.shard)
+    elif args.command == "migrate":
+        migrate_store(args.dtype, args.index_type, args.k, args.sample, args.shard)
+    elif args.command == "verify":
+        if not verify_store(args.shard, args.sample)["ok"]:
+            raise SystemExit(1)
+    elif args.command == "compact":
+        compact_store(args.shard, args.index_type, args.k, args.sample)
+
+
+if __name__ == "__main__":
+    main()
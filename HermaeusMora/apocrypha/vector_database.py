@@ -1,18 +1,28 @@
 import os
+import re
 import json
+import sqlite3
+import time
 import hashlib
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
+from urllib.parse import unquote, urlparse
 
 import numpy as np
 import faiss
 import ollama
 
+from apocrypha.embedding_buffer import EmbeddingBuffer
+from apocrypha.embedding_cache import EmbeddingCache
+from apocrypha.write_ahead_log import WriteAheadLog
+from utility_scripts.file_lock import FileLock
+from utility_scripts.ollama_scheduler import get_scheduler, INGESTION
 from utility_scripts.system_logging import setup_logger
 
-# ToDo
-# Check if info is already in the data base, to avoid duplicates
-
-
 # configure logging
 logger = setup_logger(__name__)
 
@@ -20,86 +30,622 @@ logger = setup_logger(__name__)
 # PATHS
 base_dir = Path(__file__).resolve().parent / "database"
 base_dir.mkdir(exist_ok=True)
-faiss_path = base_dir / "faiss.bin"
-embeddings_path = base_dir / "embeddings.npy"
-metadata_path = base_dir / "metadata.json"
+shards_dir = base_dir / "shards"
+embedding_cache_path = base_dir / "embedding_cache.db"
+
+# The default shard lives directly in base_dir, other shards under shards/<name>
+DEFAULT_SHARD = "default"
 
 EMBEDDING_MODEL = "embeddinggemma"
 
+# Batched embedding settings
+EMBED_BATCH_SIZE = 32       # chunks sent per ollama.embed call
+EMBED_MAX_IN_FLIGHT = 4     # batches allowed to be running at once
+
+EMBEDDING_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Chunks ingested between checkpoints of embeddings.npy, faiss.bin is only written when an ingestion ends
+CHECKPOINT_EVERY = 1024
+
+# Storage precision of embeddings.npy and the embedding cache, "float32" or "float16"
+EMBEDDINGS_DTYPE = "float32"
+
+# FAISS index settings
+INDEX_TYPES = ("flat", "hnsw", "ivf", "sq8", "sq_fp16", "ivfpq")
+INDEX_TYPE = "auto"         # one of INDEX_TYPES or "auto"
+ANN_THRESHOLD = 100_000     # vectors before "auto" switches from flat to ivf, which removes in place
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+PQ_BYTES = 64               # bytes per vector for ivfpq, rounded to a divisor of the dimension
+INDEX_ADD_BLOCK = 65_536    # rows added per call when building from embeddings.npy
+
+# Serve recalls from a read-only memory-mapped faiss.bin. Windows cannot replace a
+# mapped file, so save_faiss would fail while a reader holds it there.
+FAISS_MMAP = os.name != "nt"
+
+# BM25 term index kept next to the metadata, needs SQLite built with FTS5
+LEXICAL_INDEX = True
+LEXICAL_TOKENIZER = "porter unicode61 remove_diacritics 2"
+LEXICAL_STOPWORDS = frozenset(
+    "a an and are as at be by did do does for from has have how in is it its of on or that the this to "
+    "was were what when where which who whom whose why will with".split()
+)
+
+# Recall filters, see normalize_filters
+FILTER_KEYS = ("source", "namespace", "ingested_after", "ingested_before")
+FILTER_EXACT_MAX = 16_384   # filtered ANN searches over at most this many chunks are done exactly
+FAISS_MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+# -------------------
+# Shards
+# -------------------
+class Shard:
+    """
+    One independently loadable part of the store, for example a site or a wiki namespace.
+    Each shard has its own index, embeddings cache, metadata, write-ahead log and
+    generation stamp, so writing to one never touches the files of another.
+    """
+
+    def __init__(self, name: str):
+        if not re.fullmatch(r"[A-Za-z0-9._-]+", name):
+            raise ValueError(f"Invalid shard name: {name}")
+        self.name = name
+        self.dir = base_dir if name == DEFAULT_SHARD else shards_dir / name
+        self.faiss_path = self.dir / "faiss.bin"
+        self.embeddings_path = self.dir / "embeddings.npy"
+        self.metadata_path = self.dir / "metadata.json"  # legacy store, imported into metadata.db on first use
+        self.metadata_db_path = self.dir / "metadata.db"
+        self.generation_path = self.dir / "generation"
+        self.wal_path = self.dir / "ingest.wal"
+        self.compact_marker_path = self.dir / "compact.pending"
+        self.file_lock = FileLock(self.dir / "write.lock")  # held by the process writing the shard
+
+        self.metadata_db = None
+        self.metadata_inode = None
+        self.lexical = False
+        self.metadata_lock = threading.RLock()  # re-entered by callers that hold it around get_metadata_db
+        self.write_lock = threading.Lock()  # held by one ingestion at a time
+
+    def create(self):
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def writing(self):
+        """ Hold the shard's write lock against other threads and, through write.lock, other processes. """
+        with self.write_lock, self.file_lock:
+            yield
+
+    def exists(self) -> bool:
+        return self.faiss_path.exists() or self.embeddings_path.exists()
+
+    def __repr__(self):
+        return f"Shard({self.name})"
+
+
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+def get_shard(shard=None) -> Shard:
+    """
+    :param shard: Shard, shard name, or None for the default shard
+    :return: the process wide Shard object
+    """
+    if isinstance(shard, Shard):
+        return shard
+    name = shard or DEFAULT_SHARD
+    with _shards_lock:
+        if name not in _shards:
+            _shards[name] = Shard(name)
+        return _shards[name]
+
+
+def list_shards():
+    """ :return: names of the shards that hold data """
+    names = [DEFAULT_SHARD] if get_shard(DEFAULT_SHARD).exists() else []
+    if shards_dir.exists():
+        names += sorted(path.name for path in shards_dir.iterdir() if path.is_dir() and get_shard(path.name).exists())
+    return names
+
 
 # -------------------
 # Getter functions
 # -------------------
-def get_faiss():
-    """ :return: faiss index or None"""
+def get_faiss(mmap=False, shard=None):
+    """
+    :param mmap: map the index read-only instead of copying it into memory.
+        Pages are shared between processes, but vectors must never be added to such an index.
+    :param shard: shard to read, the default shard if None
+    :return: faiss index or None
+    """
+    faiss_path = get_shard(shard).faiss_path
     if os.path.exists(faiss_path):
-        index = faiss.read_index(str(faiss_path))
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(str(faiss_path), FAISS_MMAP_FLAGS)
+            except RuntimeError as e:
+                logger.warning(f"Could not memory map {faiss_path.name}, reading it instead: {e}")
+        if index is None:
+            index = faiss.read_index(str(faiss_path))
+        configure_search(index)
         return index
     return None
 
 
-def get_embeddings_path():
-    return embeddings_path
+def get_generation(shard=None) -> int:
+    """ :return: version stamp of the shard's index, bumped on every save_faiss """
+    try:
+        with open(get_shard(shard).generation_path, "r") as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
 
+def get_embeddings_path(shard=None):
+    return get_shard(shard).embeddings_path
 
-def get_metadata_path():
-    return metadata_path
+
+def get_metadata_path(shard=None):
+    return get_shard(shard).metadata_db_path
 
 
 # -------------------
 # Metadata functions
 # -------------------
-def json_builder(faiss_index: int, chunk_index: int, content: str) -> dict:
+def content_hash(content: str) -> str:
+    """ :return: sha256 hex digest used to identify a chunk's content """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def source_namespace(source: str):
+    """ :return: wiki namespace of a page URL, "Lore" for .../wiki/Lore:Hermaeus_Mora, None if it has none """
+    if not source:
+        return None
+    title = unquote(urlparse(source).path.rstrip("/").rsplit("/", 1)[-1])
+    return title.split(":", 1)[0] if ":" in title else None
+
+
+def json_builder(faiss_index: int, chunk_index: int, content: str, hash_content: str = None,
+                 source: str = None, ingested_at: int = None) -> dict:
     """
     Build a metadata entry for a chunk.
-    :param faiss_index: Index in Faiss DB
+    :param faiss_index: Index in Faiss DB, also the chunk's stable ID
     :param chunk_index: Index of the current Chunk
     :param content: The content of the chunk
+    :param hash_content: Precomputed content hash, computed if not given
+    :param source: URL the chunk was taken from
+    :param ingested_at: unix time of the ingestion, now if not given
     :return: dict to be json data
     """
-    hash_content = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    if hash_content is None:
+        hash_content = content_hash(content)
 
     return {
         "faiss_index": faiss_index,
         "chunk_index": chunk_index,
         "hash": hash_content,
         "content": content,
+        "source": source,
+        "namespace": source_namespace(source),
+        "ingested_at": int(time.time()) if ingested_at is None else ingested_at,
     }
 
 
-def save_metadata(chunk_metadata):
+def get_metadata_db(shard=None):
     """
-    Save a single chunk metadata to metadata.json.
-    Appends to existing list or creates a new one.
+    Open (once) the SQLite metadata store keyed by faiss_index.
+    Imports a legacy metadata.json the first time the store is created. The connection is
+    opened again when another process has replaced metadata.db, for example by compacting.
+    Call it while holding shard.metadata_lock so the connection cannot be swapped mid-use.
+    :return: sqlite3 connection
     """
-    # Check if file exists and load existing data
-    if os.path.exists(metadata_path):
-        with open(metadata_path, "r") as f:
-            json_data = json.load(f)
-            if not isinstance(json_data, list):
-                json_data = []
-    else:
-        json_data = []
+    shard = get_shard(shard)
+    # opened under the lock so concurrent first recalls do not both run the migrations
+    with shard.metadata_lock:
+        if shard.metadata_db is not None and _metadata_inode(shard) != shard.metadata_inode:
+            logger.info(f"metadata.db of {shard.name} was replaced, reopening it")
+            _drop_stale_metadata_db(shard)
+        if shard.metadata_db is None:
+            shard.create()
+            db = sqlite3.connect(shard.metadata_db_path, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "faiss_index INTEGER PRIMARY KEY, "
+                "chunk_index INTEGER, "
+                "hash TEXT, "
+                "content TEXT, "
+                "source TEXT)"
+            )
+            columns = [row[1] for row in db.execute("PRAGMA table_info(chunks)")]
+            if "source" not in columns:
+                db.execute("ALTER TABLE chunks ADD COLUMN source TEXT")
+            if "ingested_at" not in columns:
+                db.execute("ALTER TABLE chunks ADD COLUMN ingested_at INTEGER")
+            if "namespace" not in columns:
+                db.execute("ALTER TABLE chunks ADD COLUMN namespace TEXT")
+                sources = [row[0] for row in db.execute("SELECT DISTINCT source FROM chunks WHERE source IS NOT NULL")]
+                db.executemany(
+                    "UPDATE chunks SET namespace = ? WHERE source = ?",
+                    [(source_namespace(source), source) for source in sources],
+                )
+            db.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)")
+            db.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+            db.execute("CREATE INDEX IF NOT EXISTS chunks_namespace ON chunks (namespace)")
+            db.execute("CREATE INDEX IF NOT EXISTS chunks_ingested_at ON chunks (ingested_at)")
+            db.commit()
+            shard.lexical = LEXICAL_INDEX and _create_lexical_index(db)
+            _import_legacy_metadata(db, shard.metadata_path)
+            shard.metadata_db = db
+            shard.metadata_inode = _metadata_inode(shard)
+        return shard.metadata_db
+
+
+def _metadata_inode(shard: Shard):
+    """ :return: inode of the shard's metadata.db, None if it is missing """
+    try:
+        return os.stat(shard.metadata_db_path).st_ino
+    except FileNotFoundError:
+        return None
 
-    # Append new data
-    json_data.append(chunk_metadata)
 
-    # Write back to file
-    with open(metadata_path, "w") as f:
-        json.dump(json_data, f, indent=4)
+def _drop_stale_metadata_db(shard: Shard):
+    """
+    Close a connection to a metadata.db that has been replaced on disk.
+    Closing normally checkpoints and deletes the WAL by its file name, which by now
+    belongs to the replacement, so the close is told to leave the WAL alone. The old
+    file was checkpointed by the process that replaced it.
+    """
+    if hasattr(sqlite3, "SQLITE_DBCONFIG_NO_CKPT_ON_CLOSE"):
+        shard.metadata_db.setconfig(sqlite3.SQLITE_DBCONFIG_NO_CKPT_ON_CLOSE, True)
+        shard.metadata_db.close()
+    # without setconfig (Python < 3.12) the connection is left for the garbage collector
+    shard.metadata_db = None
+    shard.metadata_inode = None
 
 
-def load_metadata():
+def _create_lexical_index(db) -> bool:
     """
-    Load existing metadata.json.
-    Returns list of metadata entries or empty list if file doesn't exist.
+    Create the BM25 index over chunk content, kept in sync with the chunks table by triggers.
+    Existing chunks are indexed the first time the table is created.
+    :return: False if SQLite was built without FTS5
+    """
+    # INSERT OR REPLACE only fires the delete trigger for the replaced row with recursive triggers on
+    db.execute("PRAGMA recursive_triggers=ON")
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone() is not None:
+        return True
+
+    try:
+        db.execute(
+            "CREATE VIRTUAL TABLE chunks_fts USING fts5("
+            f"content, content='chunks', content_rowid='faiss_index', tokenize='{LEXICAL_TOKENIZER}')"
+        )
+    except sqlite3.OperationalError as e:
+        if "no such module" not in str(e):
+            raise
+        logger.warning(f"SQLite has no FTS5, lexical recall is disabled: {e}")
+        return False
+
+    db.executescript(
+        "CREATE TRIGGER chunks_fts_insert AFTER INSERT ON chunks BEGIN "
+        "INSERT INTO chunks_fts (rowid, content) VALUES (new.faiss_index, new.content); END;"
+        "CREATE TRIGGER chunks_fts_delete AFTER DELETE ON chunks BEGIN "
+        "INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.faiss_index, old.content); END;"
+        "CREATE TRIGGER chunks_fts_update AFTER UPDATE OF content ON chunks BEGIN "
+        "INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.faiss_index, old.content); "
+        "INSERT INTO chunks_fts (rowid, content) VALUES (new.faiss_index, new.content); END;"
+    )
+    db.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+    db.commit()
+    return True
+
+
+def close_metadata_db(shard=None):
+    """ Checkpoint and close the shard's metadata connection, the next access opens it again. """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        if shard.metadata_db is not None:
+            shard.metadata_db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            shard.metadata_db.close()
+            shard.metadata_db = None
+            shard.metadata_inode = None
+
+
+def _import_legacy_metadata(db, metadata_path):
+    """ Copy entries from the old metadata.json into an empty metadata.db """
+    if not os.path.exists(metadata_path):
+        return
+    if db.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is not None:
+        return
+
+    with open(metadata_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        return
+
+    logger.info(f"Importing {len(data)} entries from {metadata_path.name}")
+    _insert_metadata(db, data)
+
+
+def _insert_metadata(db, entries):
+    db.executemany(
+        "INSERT OR REPLACE INTO chunks (faiss_index, chunk_index, hash, content, source, namespace, ingested_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                entry["faiss_index"], entry["chunk_index"], entry["hash"], entry["content"], entry.get("source"),
+                entry.get("namespace", source_namespace(entry.get("source"))), entry.get("ingested_at"),
+            )
+            for entry in entries
+        ],
+    )
+    db.commit()
+
+
+def save_metadata(chunk_metadata, shard=None):
+    """
+    Save a single chunk metadata to metadata.db.
+    """
+    save_metadata_batch([chunk_metadata], shard)
+
+
+def save_metadata_batch(entries, shard=None):
     """
-    if os.path.exists(metadata_path):
-        with open(metadata_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, list):
-                logger.info("Loading Metadata")
-                return data
+    Save a list of chunk metadata entries to metadata.db in one transaction.
+    """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        _insert_metadata(db, entries)
+
+
+def get_metadata(faiss_indices, shard=None):
+    """
+    Fetch metadata entries for the given faiss indices.
+    :param faiss_indices: iterable of faiss indices
+    :return: dict of faiss_index -> metadata entry, missing indices are left out
+    """
+    faiss_indices = [int(idx) for idx in faiss_indices]
+    if not faiss_indices:
+        return {}
+
+    shard = get_shard(shard)
+    placeholders = ",".join("?" * len(faiss_indices))
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        rows = db.execute(
+            f"SELECT * FROM chunks WHERE faiss_index IN ({placeholders})", faiss_indices
+        ).fetchall()
+    return {row["faiss_index"]: dict(row) for row in rows}
+
+
+def find_known_hashes(hashes, shard=None):
+    """
+    Check which content hashes are already stored.
+    :param hashes: iterable of sha256 hex digests
+    :return: set of the hashes that already have a metadata entry
+    """
+    hashes = list(set(hashes))
+    known = set()
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        # stay well below SQLite's bound parameter limit
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = db.execute(f"SELECT hash FROM chunks WHERE hash IN ({placeholders})", batch).fetchall()
+            known.update(row[0] for row in rows)
+    return known
+
+
+def get_source_chunks(source, shard=None):
+    """
+    :param source: URL the chunks were taken from
+    :return: dict of content hash -> faiss_index for the source's chunks
+    """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        rows = db.execute("SELECT hash, faiss_index FROM chunks WHERE source = ?", (source,)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def update_chunk_indices(positions, shard=None):
+    """
+    Update the chunk_index of stored chunks, used when a page is re-chunked.
+    :param positions: dict of faiss_index -> chunk_index
+    """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        db.executemany(
+            "UPDATE chunks SET chunk_index = ? WHERE faiss_index = ?",
+            [(chunk_index, faiss_index) for faiss_index, chunk_index in positions.items()],
+        )
+        db.commit()
+
+
+def delete_metadata(faiss_indices, shard=None):
+    """
+    Delete metadata entries by faiss index.
+    :return: number of deleted entries
+    """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        deleted = db.executemany(
+            "DELETE FROM chunks WHERE faiss_index = ?", [(int(idx),) for idx in faiss_indices]
+        ).rowcount
+        db.commit()
+    return deleted
+
+
+def load_live_ids(shard=None):
+    """ :return: sorted int64 array of every faiss_index that has metadata """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        rows = db.execute("SELECT faiss_index FROM chunks ORDER BY faiss_index").fetchall()
+    return np.array([row[0] for row in rows], dtype="int64")
+
+
+def truncate_metadata(count, shard=None):
+    """
+    Delete metadata entries whose faiss_index is at or past count.
+    :return: number of deleted entries
+    """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        deleted = db.execute("DELETE FROM chunks WHERE faiss_index >= ?", (int(count),)).rowcount
+        db.commit()
+    return deleted
+
+
+def load_chunk_hashes(shard=None):
+    """ :return: (sorted int64 array of chunk IDs, array of their content hashes, array of their sources) """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        rows = db.execute("SELECT faiss_index, hash, source FROM chunks ORDER BY faiss_index").fetchall()
+    return (
+        np.array([row[0] for row in rows], dtype="int64"),
+        np.array([row[1] or "" for row in rows], dtype=object),
+        np.array([row[2] or "" for row in rows], dtype=object),
+    )
+
+
+def count_metadata(shard=None):
+    """ :return: number of metadata entries """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        return db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+
+def normalize_filters(filters):
+    """
+    Validate recall filters and bring them into a hashable, canonical form.
+    :param filters: dict with any of
+        "source" / "namespace": a value or a list of accepted values,
+        "ingested_after" / "ingested_before": datetime or unix time, the end is exclusive
+    :return: tuple of (key, value) clauses, None for no filter
+    """
+    if not filters:
+        return None
+    if isinstance(filters, tuple):
+        return filters
+
+    unknown = set(filters) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown filter: {', '.join(sorted(unknown))}")
+
+    clauses = []
+    for key in FILTER_KEYS:
+        value = filters.get(key)
+        if value is None:
+            continue
+        if key in ("source", "namespace"):
+            value = tuple(sorted({value} if isinstance(value, str) else set(value)))
+        else:
+            value = value.timestamp() if isinstance(value, datetime) else float(value)
+        clauses.append((key, value))
+    return tuple(clauses) or None
+
+
+def filter_clause(filters):
+    """ :return: (SQL condition on the chunks table, parameters) for normalized filters """
+    conditions, params = [], []
+    for key, value in filters or ():
+        if key in ("source", "namespace"):
+            conditions.append(f"chunks.{key} IN ({','.join('?' * len(value))})")
+            params.extend(value)
+        elif key == "ingested_after":
+            conditions.append("chunks.ingested_at >= ?")
+            params.append(value)
+        elif key == "ingested_before":
+            conditions.append("chunks.ingested_at < ?")
+            params.append(value)
+    return " AND ".join(conditions) or "1", params
+
+
+def filter_ids(filters, shard=None):
+    """ :return: sorted int64 array of the chunk IDs matching the filters """
+    shard = get_shard(shard)
+    condition, params = filter_clause(normalize_filters(filters))
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        rows = db.execute(f"SELECT faiss_index FROM chunks WHERE {condition} ORDER BY faiss_index", params).fetchall()
+    return np.array([row[0] for row in rows], dtype="int64")
+
+
+def lexical_terms(query: str):
+    """ :return: the distinct search terms of a query, stopwords left out """
+    terms = []
+    for term in re.findall(r"\w+", query.lower()):
+        if term not in LEXICAL_STOPWORDS and term not in terms:
+            terms.append(term)
+    return terms
+
+
+def search_lexical(query: str, limit: int, shard=None, match_all=False, filters=None):
+    """
+    Rank chunks by BM25 over the terms of a query.
+    :param query: raw query text
+    :param limit: maximum number of hits
+    :param match_all: only return chunks containing every term
+    :param filters: recall filters, see normalize_filters
+    :return: list of (faiss_index, score) with the best, highest score first
+    """
+    shard = get_shard(shard)
+    terms = lexical_terms(query)
+    if not terms:
+        return []
+
+    # quoting keeps terms like "and" or "near" from being read as FTS5 operators
+    match = (" AND " if match_all else " OR ").join(f'"{term}"' for term in terms)
+    filters = normalize_filters(filters)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        if not shard.lexical:
+            return []
+        if filters is None:
+            rows = db.execute(
+                "SELECT rowid, bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? "
+                "ORDER BY bm25(chunks_fts) LIMIT ?",
+                (match, int(limit)),
+            ).fetchall()
+        else:
+            condition, params = filter_clause(filters)
+            rows = db.execute(
+                "SELECT chunks_fts.rowid, bm25(chunks_fts) FROM chunks_fts "
+                "JOIN chunks ON chunks.faiss_index = chunks_fts.rowid "
+                f"WHERE chunks_fts MATCH ? AND {condition} ORDER BY bm25(chunks_fts) LIMIT ?",
+                (match, *params, int(limit)),
+            ).fetchall()
+    # FTS5 reports BM25 negated so that ascending order is best first
+    return [(row[0], -row[1]) for row in rows]
+
+
+def load_metadata(shard=None):
+    """
+    Load every metadata entry ordered by faiss index.
+    Returns list of metadata entries or empty list if there are none.
+    """
+    shard = get_shard(shard)
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        rows = db.execute("SELECT * FROM chunks ORDER BY faiss_index").fetchall()
+    if rows:
+        logger.info("Loading Metadata")
+        return [dict(row) for row in rows]
     logger.info("No Previous Metadata Found")
     return []
 
@@ -120,26 +666,91 @@ def chunk_loader(chunk_path):
 # -------------------
 # Embeddings
 # -------------------
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """ :return: the on-disk EmbeddingCache, opened on first use """
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(embedding_cache_path, EMBEDDING_CACHE_MAX_BYTES, EMBEDDINGS_DTYPE)
+    return _embedding_cache
+
+
 def embed_content(content):
     """
     Generate a single embedding for a chunk and reshape for FAISS.
     :return: (1, dim) array and dim.
     """
-    embedding_model = "embeddinggemma"
-    resp = ollama.embed(model=embedding_model, input=content)
-    embedding = resp["embeddings"][0]
+    return embed_batch([content])
+
+
+def embed_batch(contents, priority=INGESTION):
+    """
+    Generate embeddings for a list of chunks, only sending cache misses to Ollama.
+    :param contents: list of strings to embed
+    :param priority: scheduler class of the request, QUERY for the embeddings of a recall
+    :return: (n, dim) array and dim.
+    """
+    cache = get_embedding_cache()
+    hashes = [content_hash(content) for content in contents]
+    cached = cache.get_many(EMBEDDING_MODEL, hashes)
 
-    # reshape to 2D for FAISS
-    embedding_vectors = np.array(embedding, dtype="float32").reshape(1, -1)
+    # embed everything that was not cached in a single request
+    missing = {}
+    for content, hash_content in zip(contents, hashes):
+        if hash_content not in cached:
+            missing.setdefault(hash_content, content)
+
+    if missing:
+        with get_scheduler().slot(priority):
+            resp = ollama.embed(model=EMBEDDING_MODEL, input=list(missing.values()))
+        embedded = dict(zip(missing, np.array(resp["embeddings"], dtype="float32")))
+        cache.put_many(EMBEDDING_MODEL, embedded)
+        cached.update(embedded)
+
+    embedding_vectors = np.vstack([cached[hash_content] for hash_content in hashes]).astype("float32", copy=False)
     dim = embedding_vectors.shape[1]
 
     return embedding_vectors, dim
 
 
-def load_embeddings():
+def embed_batches(contents, batch_size=EMBED_BATCH_SIZE, max_in_flight=EMBED_MAX_IN_FLIGHT):
+    """
+    Embed a list of chunks in batches, keeping a bounded number of requests in flight.
+    Batches are yielded in input order.
+    :param contents: list of strings to embed
+    :param batch_size: number of chunks per ollama.embed call
+    :param max_in_flight: maximum number of batches being embedded at once
+    :return: generator of (start, vectors, dim) where start is the offset of the batch in contents
+    """
+    batch_size = max(1, batch_size)
+    max_in_flight = max(1, max_in_flight)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = deque()
+
+        for start in range(0, len(contents), batch_size):
+            # wait for the oldest batch before submitting more than allowed
+            if len(pending) >= max_in_flight:
+                done_start, future = pending.popleft()
+                yield done_start, *future.result()
+
+            batch = contents[start:start + batch_size]
+            pending.append((start, executor.submit(embed_batch, batch)))
+
+        while pending:
+            done_start, future = pending.popleft()
+            yield done_start, *future.result()
+
+
+def load_embeddings(shard=None):
     """
     Load existing embeddings cache or return empty array.
     """
+    embeddings_path = get_shard(shard).embeddings_path
     if os.path.exists(embeddings_path):
         logger.info("Embeddings Found")
         return np.load(embeddings_path)
@@ -147,35 +758,476 @@ def load_embeddings():
     return np.empty((0, 0), dtype="float32")
 
 
-def save_embeddings(all_embeddings):
+def open_embeddings(shard=None):
+    """
+    Open the embeddings cache for in-place appends.
+    :return: EmbeddingBuffer over the shard's embeddings.npy
+    """
+    shard = get_shard(shard)
+    shard.create()
+    return EmbeddingBuffer(shard.embeddings_path, dtype=EMBEDDINGS_DTYPE)
+
+
+def save_embeddings(all_embeddings, shard=None):
     """
     Save the embeddings cache to .npy.
     """
-    np.save(embeddings_path, all_embeddings)
+    np.save(get_shard(shard).embeddings_path, all_embeddings)
 
 
 # -------------------
 # FAISS incremental functions
 # -------------------
-def load_or_create_faiss_index(dim: int):
+def load_or_create_faiss_index(dim: int, shard=None):
+    faiss_path = get_shard(shard).faiss_path
     if os.path.exists(faiss_path):
         index = faiss.read_index(str(faiss_path))
         if index.d != dim:
             raise ValueError(f"FAISS dimension mismatch: expected {dim}, got {index.d}")
-        return index
+        configure_search(index)
+        return ensure_id_map(index, shard)
     else:
         # Create empty FAISS index
-        index = faiss.IndexFlatL2(dim)
+        index = create_faiss_index(dim, resolve_index_type(INDEX_TYPE, 0))
+        if not index.is_trained:
+            # trained indexes need data first, start flat and rebuild once vectors exist
+            logger.info(f"{describe_index(index)} index needs training data, starting with a flat index")
+            index = create_faiss_index(dim, "flat")
         return index
 
 
-def append_to_faiss(index, vectors):
+def append_to_faiss(index, vectors, ids):
     """
     Add new vectors to an existing FAISS index.
+    :param ids: stable chunk IDs of the vectors, their rows in embeddings.npy
+    """
+    index.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), np.asarray(ids, dtype="int64"))
+
+
+def remove_from_faiss(index, ids, shard=None):
+    """
+    Remove vectors by chunk ID.
+    Index types that cannot remove (HNSW) are rebuilt from embeddings.npy and the
+    remaining metadata, so metadata must already be deleted. That costs a pass over the
+    whole shard, which is why "auto" grows into IVF instead.
+    :return: the index to keep using
+    """
+    ids = np.asarray(ids, dtype="int64")
+    if len(ids) == 0:
+        return index
+    try:
+        index.remove_ids(ids)
+        return index
+    except RuntimeError:
+        logger.info(f"{describe_index(index)} index cannot remove vectors, rebuilding it")
+        embeddings = np.load(get_shard(shard).embeddings_path, mmap_mode="r")
+        return build_faiss_index(embeddings, describe_index(index), load_live_ids(shard))
+
+
+def has_native_ids(index) -> bool:
+    """ :return: True for IVF indexes, which store chunk IDs in their inverted lists instead of an ID map """
+    return isinstance(index, faiss.IndexIVF)
+
+
+def ensure_id_map(index, shard=None):
+    """
+    Wrap a legacy index in an IndexIDMap2 keyed by embeddings row.
+    IVF indexes keep their IDs natively, an IVF inside an ID map is rebuilt without it
+    because IndexIDMap2.remove_ids leaves the inverted lists pointing at stale positions.
+    :return: ID-mapped index
+    """
+    if has_native_ids(index):
+        if index.direct_map.type == faiss.DirectMap.NoMap:
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+    if isinstance(index, faiss.IndexIDMap):
+        if not has_native_ids(base_index(index)):
+            return index
+        logger.info(f"Converting {describe_index(index)} index with {index.ntotal} vectors to native IVF IDs")
+        embeddings = np.load(get_shard(shard).embeddings_path, mmap_mode="r")
+        return build_faiss_index(embeddings, describe_index(index), np.sort(get_index_ids(index)))
+    if index.ntotal == 0:
+        return faiss.IndexIDMap2(index)
+
+    logger.info(f"Converting {describe_index(index)} index with {index.ntotal} vectors to stable chunk IDs")
+    embeddings = np.load(get_shard(shard).embeddings_path, mmap_mode="r")
+    return build_faiss_index(embeddings, describe_index(index), np.arange(index.ntotal, dtype="int64"))
+
+
+def get_index_ids(index):
+    """ :return: int64 array of the chunk IDs stored in an ID-mapped or IVF index """
+    if not has_native_ids(index):
+        return faiss.vector_to_array(index.id_map).astype("int64", copy=False)
+
+    invlists = index.invlists
+    ids = []
+    for list_no in range(index.nlist):
+        size = invlists.list_size(list_no)
+        if size:
+            list_ids = invlists.get_ids(list_no)
+            ids.append(faiss.rev_swig_ptr(list_ids, size).astype("int64"))
+            invlists.release_ids(list_no, list_ids)
+    return np.concatenate(ids) if ids else np.empty(0, dtype="int64")
+
+
+# -------------------
+# FAISS index types
+# -------------------
+def resolve_index_type(index_type: str, ntotal: int) -> str:
+    """
+    Pick the concrete index type.
+    :param index_type: one of INDEX_TYPES or "auto"
+    :param ntotal: number of vectors the index will hold
+    :return: one of INDEX_TYPES
     """
-    index.add(vectors)
+    if index_type == "auto":
+        return "flat" if ntotal < ANN_THRESHOLD else "ivf"
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {index_type}")
+    return index_type
+
+
+def base_index(index):
+    """ :return: the index inside an ID map, or the index itself """
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def describe_index(index) -> str:
+    """ :return: the index type name used by resolve_index_type """
+    index = base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "sq_fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "flat"
+
+
+def ivf_nlist(ntotal: int) -> int:
+    """ :return: number of IVF lists for a corpus, about 4 * sqrt(n) """
+    return max(1, min(int(4 * np.sqrt(ntotal)), ntotal // 39 or 1))
+
+
+def pq_subquantizers(dim: int) -> int:
+    """ :return: the largest divisor of dim that is at most PQ_BYTES """
+    return max(m for m in range(1, min(dim, PQ_BYTES) + 1) if dim % m == 0)
+
+
+def create_faiss_index(dim: int, index_type: str, ntotal: int = 0):
+    """
+    Create an empty ID-mapped index of the given type.
+    IVF indexes are not wrapped, they store the chunk IDs in their inverted lists
+    and find them again through a hash table direct map.
+    :param ntotal: expected number of vectors, used to size IVF
+    """
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit)
+    elif index_type == "sq_fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    elif index_type == "ivf":
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, ivf_nlist(ntotal))
+    elif index_type == "ivfpq":
+        quantizer = faiss.IndexFlatL2(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, ivf_nlist(ntotal), pq_subquantizers(dim), 8)
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+
+    configure_search(index)
+    if has_native_ids(index):
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        return index
+    return faiss.IndexIDMap2(index)
+
+
+def configure_search(index):
+    """ Apply query-time settings to ANN indexes. """
+    index = base_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_NPROBE
+
+
+def is_exhaustive(index) -> bool:
+    """ :return: True if a search compares the query with every stored vector """
+    return describe_index(index) in ("flat", "sq8", "sq_fp16")
+
+
+def search_parameters(index, selector):
+    """ :return: search parameters restricting a search to a selector, keeping the configured efSearch / nprobe """
+    inner = base_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+
+def build_faiss_index(embeddings, index_type=INDEX_TYPE, ids=None):
+    """
+    Build a populated index from an embedding matrix in bulk.
+    :param embeddings: (n, dim) array, can be a memory map
+    :param index_type: one of INDEX_TYPES or "auto"
+    :param ids: sorted chunk IDs (embedding rows) to include, all rows if None
+    :return: ID-mapped FAISS index
+    """
+    if ids is None:
+        ids = np.arange(embeddings.shape[0], dtype="int64")
+    ntotal, dim = len(ids), embeddings.shape[1]
+    index_type = resolve_index_type(index_type, ntotal)
+    index = create_faiss_index(dim, index_type, ntotal)
+
+    if index_type == "ivfpq" and ntotal < 256 * 39:
+        raise ValueError(f"ivfpq needs at least {256 * 39} vectors to train, got {ntotal}")
+
+    if not index.is_trained:
+        # train on a random sample, at least ~256 points per IVF list
+        rng = np.random.default_rng(0)
+        sample_size = min(ntotal, max(65_536, 256 * getattr(base_index(index), "nlist", 0)))
+        sample = np.sort(rng.choice(ids, sample_size, replace=False))
+        logger.info(f"Training {index_type} index on {sample_size} vectors")
+        index.train(np.ascontiguousarray(embeddings[sample], dtype="float32"))
+
+    logger.info(f"Building {index_type} index with {ntotal} vectors")
+    for start in range(0, ntotal, INDEX_ADD_BLOCK):
+        block_ids = ids[start:start + INDEX_ADD_BLOCK]
+        append_to_faiss(index, embeddings[block_ids], block_ids)
+
+    return index
+
+
+def evaluate_recall(index, embeddings, ids=None, k=10, sample_size=1000):
+    """
+    Measure recall@k of an index against an exact brute-force search.
+    Queries are sampled from the stored embeddings.
+    :param ids: chunk IDs held by the index, all rows if None
+    :return: recall@k between 0 and 1
+    """
+    if ids is None:
+        ids = np.arange(embeddings.shape[0], dtype="int64")
+    ntotal = len(ids)
+    if ntotal == 0:
+        return 1.0
+    k = min(k, ntotal)
+
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(ids, min(sample_size, ntotal), replace=False))
+    queries = np.ascontiguousarray(embeddings[sample], dtype="float32")
+
+    _, approx = index.search(queries, k)
+    _, exact = faiss.knn(queries, np.ascontiguousarray(embeddings[ids], dtype="float32"), k)
+    exact = ids[exact]
+
+    hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approx, exact))
+    return hits / (len(queries) * k)
+
+
+def upgrade_index_if_needed(index, shard=None):
+    """
+    Apply the "auto" policy: replace a flat index with an ANN index once it
+    grows past ANN_THRESHOLD. The new index is built from embeddings.npy.
+    :return: the index to keep using
+    """
+    if INDEX_TYPE != "auto" or describe_index(index) != "flat" or index.ntotal < ANN_THRESHOLD:
+        return index
+
+    logger.info(f"Index reached {index.ntotal} vectors, switching to an ANN index")
+    embeddings = np.load(get_shard(shard).embeddings_path, mmap_mode="r")
+    return build_faiss_index(embeddings, "auto", load_live_ids(shard))
+
+
+def save_faiss(index, shard=None):
+    """
+    Write the FAISS index and bump the generation stamp.
+    The index is written to a temporary file first so readers never see a partial write.
+    """
+    shard = get_shard(shard)
+    shard.create()
+    tmp_path = shard.faiss_path.with_suffix(".tmp")
+    faiss.write_index(index, str(tmp_path))
+    os.replace(tmp_path, shard.faiss_path)
+    bump_generation(shard)
+
+
+def bump_generation(shard=None):
+    """ Increase the generation stamp so resident readers reload the index. """
+    shard = get_shard(shard)
+    generation = get_generation(shard) + 1
+    tmp_path = shard.generation_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(str(generation))
+    os.replace(tmp_path, shard.generation_path)
+    return generation
+
+
+# -------------------
+# Checkpoints and recovery
+# -------------------
+def open_write_ahead_log(shard=None):
+    """ :return: WriteAheadLog of batches not yet checkpointed """
+    shard = get_shard(shard)
+    shard.create()
+    return WriteAheadLog(shard.wal_path)
+
+
+def checkpoint(embeddings, wal):
+    """
+    Make the embeddings ingested so far durable and empty the write-ahead log.
+    Metadata is committed with every batch, and the index is not written: after a crash
+    recover_store adds the flushed rows missing from faiss.bin back from embeddings.npy,
+    so a checkpoint neither rewrites the whole index nor bumps the generation readers watch.
+    :param embeddings: open EmbeddingBuffer
+    :param wal: WriteAheadLog to reset
+    """
+    embeddings.flush()
+    wal.reset()
+    logger.debug(f"Checkpoint at {embeddings.count} vectors")
+
+
+def reconcile_index(index, embeddings, live_ids, shard=None):
+    """
+    Make the index hold exactly the live chunk IDs.
+    :param embeddings: (n, dim) array with a row for every live ID, flushed to embeddings.npy
+    :param live_ids: sorted chunk IDs that have metadata
+    :return: (index to keep using, number of added IDs, number of removed IDs)
+    """
+    stored_ids = get_index_ids(index)
+    missing = np.setdiff1d(live_ids, stored_ids, assume_unique=True)
+    extra = np.setdiff1d(stored_ids, live_ids, assume_unique=True)
+
+    reduced = remove_from_faiss(index, extra, shard)
+    if reduced is not index:
+        # the index was rebuilt from every live ID, nothing left to add
+        return reduced, len(missing), len(extra)
+
+    for start in range(0, len(missing), INDEX_ADD_BLOCK):
+        block_ids = missing[start:start + INDEX_ADD_BLOCK]
+        append_to_faiss(index, embeddings[block_ids], block_ids)
+    return index, len(missing), len(extra)
+
+
+def staged_path(path):
+    """ :return: where a compaction stages the replacement of a store file """
+    return path.with_name(f"{path.name}.compact")
+
+
+def finish_compaction(shard=None):
+    """
+    Move the files staged by a compaction into place.
+    The marker is only written once every staged file is complete, so with the marker
+    present the swap is rolled forward, without it leftover staged files are discarded.
+    :return: True if a compaction was completed
+    """
+    shard = get_shard(shard)
+    targets = (shard.embeddings_path, shard.metadata_db_path, shard.faiss_path)
+    if not shard.compact_marker_path.exists():
+        for path in targets:
+            if staged_path(path).exists():
+                logger.warning(f"Discarding unfinished compaction file {staged_path(path).name}")
+                os.remove(staged_path(path))
+        return False
+
+    # the old database's WAL files must not be applied to the replacement
+    close_metadata_db(shard)
+    for suffix in ("-wal", "-shm"):
+        leftover = shard.metadata_db_path.with_name(shard.metadata_db_path.name + suffix)
+        if leftover.exists():
+            os.remove(leftover)
+
+    for path in targets:
+        if staged_path(path).exists():
+            os.replace(staged_path(path), path)
+    os.remove(shard.compact_marker_path)
+    generation = bump_generation(shard)
+    logger.info(f"Compacted {shard.name} is live as generation {generation}")
+    return True
+
+
+def needs_recovery(shard=None) -> list:
+    """
+    Cheap check for the traces an interrupted ingestion or compaction leaves behind.
+    Reads file sizes, the embeddings.npy header, the index header and two metadata
+    aggregates, and writes nothing, so it is safe while other processes use the shard.
+    :return: reasons to run recover_store, empty if the shard looks consistent
+    """
+    shard = get_shard(shard)
+    reasons = []
+    staged = any(staged_path(path).exists() for path in (shard.embeddings_path, shard.metadata_db_path, shard.faiss_path))
+    if shard.compact_marker_path.exists() or staged:
+        reasons.append("a compaction did not finish")
+    if shard.wal_path.exists() and os.path.getsize(shard.wal_path):
+        reasons.append("the write-ahead log is not empty")
+
+    rows = len(np.load(shard.embeddings_path, mmap_mode="r")) if shard.embeddings_path.exists() else 0
+    with shard.metadata_lock:
+        db = get_metadata_db(shard)
+        count, highest = db.execute("SELECT COUNT(*), MAX(faiss_index) FROM chunks").fetchone()
+    if highest is not None and highest >= rows:
+        reasons.append(f"metadata refers to chunk {highest} but embeddings.npy has {rows} rows")
+
+    index = get_faiss(mmap=FAISS_MMAP, shard=shard)
+    ntotal = 0 if index is None else index.ntotal
+    if ntotal != count:
+        reasons.append(f"the index holds {ntotal} vectors for {count} chunks")
+    return reasons
+
+
+def recover_store(shard=None):
+    """
+    Bring embeddings.npy, faiss.bin and metadata.db back in line after an interrupted ingestion.
+    Finishes an interrupted compaction, replays the write-ahead log into the embeddings cache
+    and metadata, drops metadata that has no vector, and makes the index hold exactly the
+    chunks that have metadata.
+    :return: dict describing the repairs, empty if the store was consistent
+    """
+    shard = get_shard(shard)
+    repairs = {}
+    if finish_compaction(shard):
+        repairs["finished_compaction"] = True
+
+    with open_write_ahead_log(shard) as wal, open_embeddings(shard) as embeddings:
+        replayed = 0
+        for first_row, vectors, entries in wal.records():
+            if first_row > embeddings.count:
+                logger.error(f"Write-ahead log starts at row {first_row} but embeddings end at {embeddings.count}")
+                break
+            skip = embeddings.count - first_row
+            if skip < len(vectors):
+                embeddings.append(vectors[skip:])
+                replayed += len(vectors) - skip
+            save_metadata_batch(entries, shard)
+
+        if replayed:
+            repairs["replayed_vectors"] = replayed
+        count, dim = embeddings.count, embeddings.dim
+
+        orphans = truncate_metadata(count, shard)
+        if orphans:
+            repairs["dropped_metadata"] = orphans
 
+        if dim is not None and count > 0:
+            # compare ID sets, an interrupted replace_source can leave as many extra IDs as missing ones
+            index = load_or_create_faiss_index(dim, shard)
+            embeddings.flush()
+            index, added, removed = reconcile_index(index, embeddings.array, load_live_ids(shard), shard)
+            if added or removed:
+                repairs["index_added"] = added
+                repairs["index_removed"] = removed
+                save_faiss(index, shard)
 
-def save_faiss(index):
-    faiss.write_index(index, str(faiss_path))
+        wal.reset()
 
+    if repairs:
+        logger.warning(f"Repaired shard {shard.name}: {repairs}")
+    return repairs
@@ -0,0 +1,79 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+RECORD_MAGIC = b"HMWL"
+RECORD_HEADER = struct.Struct("<4sqIII")  # magic, first row, rows, dim, metadata bytes
+
+
+class WriteAheadLog:
+    """
+    Append-only log of embedded batches that are not yet checkpointed.
+
+    Each record holds the first embeddings row of the batch, its float32
+    vectors and its metadata entries. Records are fsynced before the batch is
+    applied, so a crash loses no embedding work. A torn record at the end of
+    the file is ignored when reading.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._file = open(self.path, "ab")
+
+    def append(self, first_row, vectors, entries):
+        """
+        Durably log one batch.
+        :param first_row: embeddings row of the first vector
+        :param vectors: (n, dim) array
+        :param entries: list of metadata entries for the batch
+        """
+        vectors = np.ascontiguousarray(vectors, dtype="<f4")
+        meta = json.dumps(entries, ensure_ascii=False).encode("utf-8")
+        header = RECORD_HEADER.pack(RECORD_MAGIC, first_row, vectors.shape[0], vectors.shape[1], len(meta))
+
+        self._file.write(header + vectors.tobytes() + meta)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def records(self):
+        """ :return: generator of (first_row, vectors, entries) in log order """
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                magic, first_row, rows, dim, meta_len = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    logger.warning(f"Corrupt record in {self.path}, ignoring the rest of the log")
+                    return
+
+                body = f.read(rows * dim * 4 + meta_len)
+                if len(body) < rows * dim * 4 + meta_len:
+                    logger.warning(f"Torn record at the end of {self.path}, ignoring it")
+                    return
+
+                vectors = np.frombuffer(body, dtype="<f4", count=rows * dim).reshape(rows, dim)
+                entries = json.loads(body[rows * dim * 4:].decode("utf-8"))
+                yield first_row, vectors, entries
+
+    def reset(self):
+        """ Empty the log after a checkpoint. """
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,12 +1,16 @@
 import asyncio
 import os
+import re
 import sys
+from functools import partial
 
 import ollama
-from ollama import Client, chat
+from ollama import AsyncClient, Client, chat
 from dotenv import load_dotenv
 
+from apocrypha.EpistolaryAcumen import RecallKnowledge, RecallKnowledgeBatch
 from hermaeus.HermaMora_Config import HermaeusMora_System_Prompt
+from utility_scripts.ollama_scheduler import get_scheduler, INTERACTIVE
 from utility_scripts.system_logging import setup_logger
 
 # configure logging
@@ -19,6 +23,33 @@ os.environ["OLLAMA_API_KEY"] = os.getenv("OLLAMA_API")
 HM_personality = HermaeusMora_System_Prompt
 HM_model_name = "HermaeusMora:latest"
 HM_base_model = "deepseek-r1:7b"
+HM_keep_alive = "30m"       # how long a warmed up model stays loaded
+
+
+def model_weights(modelfile: str) -> tuple:
+    """ :return: the FROM lines of a modelfile, which name the sha256 digests of the weight blobs """
+    return tuple(line.strip() for line in modelfile.splitlines() if line.startswith("FROM "))
+
+
+def model_system_prompt(modelfile: str):
+    """ :return: the text of the modelfile's SYSTEM instruction, None if it has none """
+    found = re.findall(r'^SYSTEM\s+(?:"""(.*?)"""|(.*?)$)', modelfile, re.MULTILINE | re.DOTALL)
+    if not found:
+        return None
+    quoted, plain = found[-1]
+    return quoted or plain
+
+
+def is_model_current(model, base, system_prompt: str) -> bool:
+    """
+    :param model: client.show response of the created model
+    :param base: client.show response of the base model
+    :return: True if the model uses the base model's current weights and the given system prompt
+    """
+    weights = model_weights(model.modelfile or "")
+    system = model_system_prompt(model.modelfile or "")
+    return bool(weights) and weights == model_weights(base.modelfile or "") \
+        and system is not None and system.strip() == system_prompt.strip()
 
 
 class HermaeusMora:
@@ -31,18 +62,30 @@ class HermaeusMora:
             'num_ctx': 16384,
             'temperature': 0.6,
         }
+        self.last_message = None
 
-    def create(self) -> None:
+    def create(self, preload: bool = False) -> None:
+        """
+        Create the model unless it already exists with the current base model and system prompt.
+        :param preload: load the model now so the first turn does not wait for it
+        """
         try:
             self.client = Client()
-            response = self.client.create(
-                model=self.model_name,
-                from_=self.base_model,
-                system=self.system_prompt,
-                stream=False,
-            )
+            if self.model_is_current():
+                logger.info(f"Model {self.model_name} is up to date")
+            else:
+                with get_scheduler().slot(INTERACTIVE):
+                    response = self.client.create(
+                        model=self.model_name,
+                        from_=self.base_model,
+                        system=self.system_prompt,
+                        stream=False,
+                    )
 
-            logger.info(f"Model created: {response['status']}")
+                logger.info(f"Model created: {response['status']}")
+
+            if preload:
+                self.warm_up()
 
         except ConnectionError:
             logger.error("Ollama is not running")
@@ -52,32 +95,268 @@ class HermaeusMora:
             logger.error(f"Unexpected error during model creation: {e}")
             sys.exit(1)
 
-    def generate(self, prompt: str) -> str:
-        options = self.options | {'think': False}
+    def model_is_current(self) -> bool:
+        try:
+            with get_scheduler().slot(INTERACTIVE):
+                model, base = self.client.show(self.model_name), self.client.show(self.base_model)
+            return is_model_current(model, base, self.system_prompt)
+        except ollama.ResponseError:
+            return False
+
+    def warm_up(self, keep_alive=HM_keep_alive) -> None:
+        """ Load the model with its num_ctx by sending an empty prompt, and keep it loaded for keep_alive. """
+        with get_scheduler().slot(INTERACTIVE):
+            self.client.generate(model=self.model_name, prompt="", options=self.options, keep_alive=keep_alive)
+        logger.info(f"Model {self.model_name} loaded for {keep_alive}")
 
-        response = ollama.generate(
-            model=self.model_name,
-            prompt=prompt,
-            options=options,
-            stream=False
-        )
+    def generate(self, prompt: str, think: bool = False, system: str = None) -> str:
+        """
+        :param think: let the model reason first, the reasoning is left out of the returned text
+        :param system: system prompt replacing the persona for this request, None to keep it
+        """
+        with get_scheduler().slot(INTERACTIVE):
+            response = ollama.generate(
+                model=self.model_name,
+                prompt=prompt,
+                system=system,
+                options=self.options,
+                think=think,
+                stream=False
+            )
         return response["response"]
 
+    def generate_stream(self, prompt: str, think: bool = True):
+        """
+        Stream the reasoning and the completion as they are generated.
+        :param think: let the model reason first
+        :return: generator of ("thinking", delta) and ("content", delta) tuples,
+            its return value is the assembled message
+        """
+        thinking, content = [], []
+        with get_scheduler().slot(INTERACTIVE):
+            for chunk in ollama.generate(
+                model=self.model_name,
+                prompt=prompt,
+                options=self.options,
+                think=think,
+                stream=True
+            ):
+                if chunk.thinking:
+                    thinking.append(chunk.thinking)
+                    yield "thinking", chunk.thinking
+                if chunk.response:
+                    content.append(chunk.response)
+                    yield "content", chunk.response
+
+        return self._finish_stream("".join(thinking), "".join(content))
+
+    def system_message(self) -> dict:
+        """ The persona, kept byte-identical between requests so Ollama can reuse its evaluated prompt prefix """
+        return {"role": "system", "content": f"{self.system_prompt}\nStay in character."}
+
+    @staticmethod
+    def user_message(prompt: str, context: str) -> dict:
+        """ The turn's retrieved context goes with the user message, after the stable prefix """
+        if not context:
+            return {"role": "user", "content": prompt}
+        return {"role": "user", "content": f"Use this context to respond to the user:\n{context}\n\n{prompt}"}
+
+    def chat_messages(self, prompt: str, context: str) -> list:
+        return [self.system_message(), self.user_message(prompt, context)]
+
     def chat(self, prompt: str, context: str) -> str:
-        options = self.options | {'think': True}
-
-        response = chat(
-            model=self.model_name,
-            messages=[
-                {"role": "system", "content": f"{HM_personality}\nStay in character.\n Use this context to respond to the user:\n{context}"},
-                {"role": "user", "content": prompt}
-            ],
-            options=options,
-            stream=False
-        )
+        with get_scheduler().slot(INTERACTIVE):
+            response = chat(
+                model=self.model_name,
+                messages=self.chat_messages(prompt, context),
+                options=self.options,
+                think=True,
+                stream=False
+            )
         print("CONTEXT:")
         print(context)
         print("=" * 60)
         print(response.message.thinking)
         print("=" * 60)
         return response.message.content
+
+    def chat_stream(self, prompt: str, context: str):
+        """
+        Stream the reasoning and the answer as they are generated.
+        :return: generator of ("thinking", delta) and ("content", delta) tuples,
+            its return value is the assembled message, also kept in last_message
+        """
+        return (yield from self.stream_messages(self.chat_messages(prompt, context)))
+
+    def stream_messages(self, messages: list):
+        """
+        Stream a reply to a prepared list of chat messages.
+        :return: generator like chat_stream
+        """
+        thinking, content = [], []
+        with get_scheduler().slot(INTERACTIVE):
+            for chunk in chat(
+                model=self.model_name,
+                messages=messages,
+                options=self.options,
+                think=True,
+                stream=True
+            ):
+                if chunk.message.thinking:
+                    thinking.append(chunk.message.thinking)
+                    yield "thinking", chunk.message.thinking
+                if chunk.message.content:
+                    content.append(chunk.message.content)
+                    yield "content", chunk.message.content
+
+        return self._finish_stream("".join(thinking), "".join(content))
+
+    def _finish_stream(self, thinking: str, content: str) -> dict:
+        self.last_message = {"role": "assistant", "content": content, "thinking": thinking}
+        logger.debug(f"Streamed response: {len(thinking)} thinking chars, {len(content)} content chars")
+        return self.last_message
+
+
+class AsyncHermaeusMora(HermaeusMora):
+    """
+    HermaeusMora for an asyncio event loop, built on ollama.AsyncClient.
+
+    Generations are awaited instead of blocking, so many conversations can be in
+    flight on one loop. Recall embeds the query and searches FAISS, both blocking
+    calls, so it runs in an executor. Streams end with the assembled message instead
+    of relying on last_message, which concurrent conversations would overwrite.
+    """
+
+    def __init__(self, executor=None):
+        """ :param executor: executor running recalls, the loop's default executor if None """
+        super().__init__()
+        self.executor = executor
+
+    async def create(self, preload: bool = False) -> None:
+        try:
+            self.client = AsyncClient()
+            if await self.model_is_current():
+                logger.info(f"Model {self.model_name} is up to date")
+            else:
+                async with get_scheduler().async_slot(INTERACTIVE):
+                    response = await self.client.create(
+                        model=self.model_name,
+                        from_=self.base_model,
+                        system=self.system_prompt,
+                        stream=False,
+                    )
+
+                logger.info(f"Model created: {response['status']}")
+
+            if preload:
+                await self.warm_up()
+
+        except ConnectionError:
+            logger.error("Ollama is not running")
+            sys.exit(1)
+
+        except Exception as e:
+            logger.error(f"Unexpected error during model creation: {e}")
+            sys.exit(1)
+
+    async def model_is_current(self) -> bool:
+        try:
+            async with get_scheduler().async_slot(INTERACTIVE):
+                model, base = await asyncio.gather(self.client.show(self.model_name), self.client.show(self.base_model))
+        except ollama.ResponseError:
+            return False
+        return is_model_current(model, base, self.system_prompt)
+
+    async def warm_up(self, keep_alive=HM_keep_alive) -> None:
+        async with get_scheduler().async_slot(INTERACTIVE):
+            await self._client().generate(model=self.model_name, prompt="", options=self.options, keep_alive=keep_alive)
+        logger.info(f"Model {self.model_name} loaded for {keep_alive}")
+
+    def _client(self) -> AsyncClient:
+        if self.client is None:
+            self.client = AsyncClient()
+        return self.client
+
+    async def recall(self, query: str, **kwargs) -> list:
+        """ RecallKnowledge run in the executor, takes the same keyword arguments. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(RecallKnowledge, query, **kwargs))
+
+    async def recall_batch(self, queries: list, **kwargs) -> list:
+        """ RecallKnowledgeBatch run in the executor, takes the same keyword arguments. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(RecallKnowledgeBatch, queries, **kwargs))
+
+    async def generate(self, prompt: str, think: bool = False, system: str = None) -> str:
+        """ Like HermaeusMora.generate """
+        async with get_scheduler().async_slot(INTERACTIVE):
+            response = await self._client().generate(
+                model=self.model_name,
+                prompt=prompt,
+                system=system,
+                options=self.options,
+                think=think,
+                stream=False
+            )
+        return response["response"]
+
+    async def generate_stream(self, prompt: str, think: bool = True):
+        """
+        Stream the reasoning and the completion as they are generated.
+        :param think: let the model reason first
+        :return: async generator of ("thinking", delta) and ("content", delta) tuples,
+            ending with ("message", assembled message)
+        """
+        thinking, content = [], []
+        async with get_scheduler().async_slot(INTERACTIVE):
+            async for chunk in await self._client().generate(
+                model=self.model_name,
+                prompt=prompt,
+                options=self.options,
+                think=think,
+                stream=True
+            ):
+                if chunk.thinking:
+                    thinking.append(chunk.thinking)
+                    yield "thinking", chunk.thinking
+                if chunk.response:
+                    content.append(chunk.response)
+                    yield "content", chunk.response
+
+        yield "message", self._finish_stream("".join(thinking), "".join(content))
+
+    async def chat(self, prompt: str, context: str) -> str:
+        async with get_scheduler().async_slot(INTERACTIVE):
+            response = await self._client().chat(
+                model=self.model_name,
+                messages=self.chat_messages(prompt, context),
+                options=self.options,
+                think=True,
+                stream=False
+            )
+        logger.debug(f"Thinking: {response.message.thinking}")
+        return response.message.content
+
+    async def chat_stream(self, prompt: str, context: str):
+        """
+        Stream the reasoning and the answer as they are generated.
+        :return: async generator of ("thinking", delta) and ("content", delta) tuples,
+            ending with ("message", assembled message)
+        """
+        thinking, content = [], []
+        async with get_scheduler().async_slot(INTERACTIVE):
+            async for chunk in await self._client().chat(
+                model=self.model_name,
+                messages=self.chat_messages(prompt, context),
+                options=self.options,
+                think=True,
+                stream=True
+            ):
+                if chunk.message.thinking:
+                    thinking.append(chunk.message.thinking)
+                    yield "thinking", chunk.message.thinking
+                if chunk.message.content:
+                    content.append(chunk.message.content)
+                    yield "content", chunk.message.content
+
+        yield "message", self._finish_stream("".join(thinking), "".join(content))
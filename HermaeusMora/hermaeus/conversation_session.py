@@ -0,0 +1,129 @@
+import re
+
+from utility_scripts.system_logging import setup_logger
+from utility_scripts.token_counter import count_message_tokens, count_tokens, MESSAGE_OVERHEAD
+
+# configure logging
+logger = setup_logger(__name__)
+
+RESPONSE_TOKENS = 4096      # num_ctx kept free for the reasoning and the answer
+MIN_RECENT_TURNS = 1        # turns never folded into the summary
+FOLD_TARGET = 0.6           # share of the budget a request is folded down to, so the next turns fit unchanged
+
+# the summary is written by a neutral note keeper, not in the persona's voice
+SUMMARY_SYSTEM = "You keep concise, factual notes of conversations. Write in the third person."
+SUMMARY_PROMPT = """Summarize this conversation between a mortal and Hermaeus Mora in at most a few sentences.
+Keep names, facts that were learned and questions that are still open. Write only the summary.
+
+{previous}Conversation:
+{turns}"""
+
+# reasoning some models still inline, an unclosed block runs to the end of the text
+THINK_BLOCK = re.compile(r"<think>.*?(?:</think>|$)", re.DOTALL)
+
+
+class ConversationSession:
+    """
+    Multi-turn conversation with HermaeusMora kept within its num_ctx budget.
+
+    Every request is laid out as
+        system: the persona, byte-identical on every turn
+        system: summary of older turns, only changes when turns are folded into it
+        user / assistant: the recent turns, as plain prompts and answers
+        user: the turn's retrieved context followed by its prompt
+    so each request starts with the previous one up to its last turn, and Ollama
+    reuses the evaluated prompt prefix instead of recomputing it.
+
+    When a request would not leave RESPONSE_TOKENS free, the oldest turns are
+    folded into the rolling summary with one generate call, down to FOLD_TARGET
+    of the budget, so the following turns append to an unchanged prefix again.
+    """
+
+    def __init__(self, hermaeus, response_tokens=RESPONSE_TOKENS):
+        """
+        :param hermaeus: HermaeusMora used for replies and summaries
+        :param response_tokens: num_ctx kept free for the reply
+        """
+        self.hermaeus = hermaeus
+        self.response_tokens = response_tokens
+        self.summary = ""
+        self.turns = []
+
+    @property
+    def budget(self) -> int:
+        """ :return: tokens a request may use """
+        return self.hermaeus.options["num_ctx"] - self.response_tokens
+
+    def history_messages(self) -> list:
+        messages = [self.hermaeus.system_message()]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"})
+        for prompt, answer in self.turns:
+            messages.append({"role": "user", "content": prompt})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    def build_messages(self, prompt: str, context: str) -> list:
+        """
+        Lay out the request for a new turn, folding old turns into the summary until it fits the budget.
+        :return: list of chat messages
+        """
+        current = self.hermaeus.user_message(prompt, context)
+        messages = self.history_messages() + [current]
+        tokens = count_message_tokens(messages)
+
+        if tokens > self.budget:
+            excess = tokens - int(self.budget * FOLD_TARGET)
+            count = 0
+            while excess > 0 and count < len(self.turns) - MIN_RECENT_TURNS:
+                prompt_past, answer_past = self.turns[count]
+                excess -= count_tokens(prompt_past) + count_tokens(answer_past) + 2 * MESSAGE_OVERHEAD
+                count += 1
+            if count:
+                self.fold_turns(count)
+                messages = self.history_messages() + [current]
+                tokens = count_message_tokens(messages)
+
+        if tokens > self.budget:
+            logger.warning(f"Request needs {tokens} tokens, {self.budget} are available")
+        return messages
+
+    def fold_turns(self, count: int) -> None:
+        """ Replace the oldest turns with an updated rolling summary. """
+        folded, self.turns = self.turns[:count], self.turns[count:]
+        previous = f"Summary so far:\n{self.summary}\n\n" if self.summary else ""
+        turns = "\n".join(f"Mortal: {prompt}\nHermaeus Mora: {answer}" for prompt, answer in folded)
+
+        summary = self.hermaeus.generate(
+            SUMMARY_PROMPT.format(previous=previous, turns=turns), think=False, system=SUMMARY_SYSTEM
+        )
+        # a closing tag left over means the block started before the text did
+        self.summary = THINK_BLOCK.sub("", summary).rpartition("</think>")[2].strip()
+        logger.debug(f"Folded {count} turns into the summary, {len(self.turns)} remain")
+
+    def chat_stream(self, prompt: str, context: str):
+        """
+        Stream a reply and remember the turn once it is complete.
+        :return: generator of ("thinking", delta) and ("content", delta) tuples,
+            its return value is the assembled message
+        """
+        message = yield from self.hermaeus.stream_messages(self.build_messages(prompt, context))
+        self.remember(prompt, message["content"])
+        return message
+
+    def remember(self, prompt: str, answer: str) -> None:
+        """ Add a turn answered elsewhere, such as from a response cache. """
+        self.turns.append((prompt, answer))
+
+    def chat(self, prompt: str, context: str) -> str:
+        """ :return: the reply, after remembering the turn """
+        stream = self.chat_stream(prompt, context)
+        while True:
+            try:
+                next(stream)
+            except StopIteration as done:
+                return done.value["content"]
+
+    def reset(self) -> None:
+        self.summary = ""
+        self.turns = []
@@ -0,0 +1,142 @@
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+from apocrypha.EpistolaryAcumen import embed_query, knowledge_generation
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+SIMILARITY_THRESHOLD = 0.92     # cosine similarity a past prompt needs to reuse its answer
+RESPONSE_CACHE_ENTRIES = 512
+RESPONSE_CACHE_TTL = 60 * 60    # seconds
+
+
+class SemanticResponseCache:
+    """
+    Answers of past prompts, found again by the meaning of a new prompt.
+
+    Look a prompt up after its recall, prompts are embedded with embed_query so the
+    lookup reuses the embedding RecallKnowledge already made. Embeddings are kept in
+    one preallocated matrix and a lookup is a single matrix-vector product.
+    Entries expire after ttl, the least recently used one makes room when the
+    cache is full, and everything is dropped when a knowledge index changes.
+    An answer is only reused for a prompt grounded on the same assembled context,
+    so a self-contained question hits in any conversation, while a follow-up such
+    as "tell me more" retrieves other context and is answered afresh.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_entries=RESPONSE_CACHE_ENTRIES,
+                 ttl=RESPONSE_CACHE_TTL, shards=None):
+        """
+        :param threshold: minimum cosine similarity for a hit
+        :param max_entries: answers kept before the least recently used one is dropped
+        :param ttl: seconds an answer stays valid, None to never expire
+        :param shards: shards the answers were recalled from, every shard if None
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shards = shards
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+        self._vectors = None
+        self._answers = [None] * max_entries
+        self._prompts = [None] * max_entries
+        self._contexts = [None] * max_entries
+        self._created = np.zeros(max_entries)
+        self._last_used = np.zeros(max_entries)
+        self._used = np.zeros(max_entries, dtype=bool)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _embed(prompt: str):
+        vector = embed_query(prompt)[0].astype("float32")
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    @staticmethod
+    def _context_key(context: str) -> str:
+        return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+    def _check_generation(self) -> bool:
+        """ Drop every answer if a knowledge index changed. :return: True if it changed since the last check """
+        generation = knowledge_generation(self.shards)
+        if generation == self.generation:
+            return False
+        changed = self.generation is not None
+        if self._used.any():
+            logger.debug("Knowledge changed, dropping cached answers")
+        self._used[:] = False
+        self.generation = generation
+        return changed
+
+    def lookup(self, prompt: str, context: str = ""):
+        """
+        :param context: assembled context the prompt would be answered from
+        :return: the cached answer of a similar enough prompt grounded on the same context, or None
+        """
+        vector = self._embed(prompt)
+        context = self._context_key(context)
+        now = time.monotonic()
+        with self._lock:
+            self._check_generation()
+            if self.ttl is not None:
+                self._used &= self._created > now - self.ttl
+
+            if self._vectors is None or not self._used.any() or self._vectors.shape[1] != len(vector):
+                self.misses += 1
+                return None
+
+            same = np.fromiter((key == context for key in self._contexts), dtype=bool, count=self.max_entries)
+            similarity = np.where(self._used & same, self._vectors @ vector, -np.inf)
+            best = int(np.argmax(similarity))
+            if similarity[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self._last_used[best] = now
+            self.hits += 1
+            logger.debug(f"Reusing the answer to \"{self._prompts[best]}\" ({similarity[best]:.3f})")
+            return self._answers[best]
+
+    def store(self, prompt: str, answer: str, context: str = "") -> None:
+        """
+        Remember an answer, unless the knowledge changed since the lookup it was produced after.
+        :param context: assembled context the answer was grounded on, as passed to lookup
+        """
+        vector = self._embed(prompt)
+        context = self._context_key(context)
+        now = time.monotonic()
+        with self._lock:
+            if self._check_generation():
+                return
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype="float32")
+                self._used[:] = False
+
+            free = np.flatnonzero(~self._used)
+            slot = int(free[0]) if len(free) else int(np.argmin(self._last_used))
+            self._vectors[slot] = vector
+            self._answers[slot] = answer
+            self._prompts[slot] = prompt
+            self._contexts[slot] = context
+            self._created[slot] = self._last_used[slot] = now
+            self._used[slot] = True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._used[:] = False
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": int(self._used.sum()),
+        }
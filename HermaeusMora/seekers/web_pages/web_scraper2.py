@@ -13,7 +13,8 @@ from docling.document_converter import DocumentConverter
 from docling.chunking import HybridChunker
 from transformers import AutoTokenizer
 
-from apocrypha.EpistolaryAcumen import RetainKnowledge
+from apocrypha.EpistolaryAcumen import replace_source
+from apocrypha.vector_database import chunk_loader
 from utility_scripts.functions import url_to_filename
 from utility_scripts.system_logging import setup_logger
 
@@ -228,7 +229,8 @@ if __name__ == "__main__":
     try:
         file_name, chunks, tokenizer, chunker = chunk_document(markdown_file)
         json_chunks = save_chunks(file_name, chunks, chunker)
-        RetainKnowledge(json_chunks)
+        # replaces the page's previous chunks, so re-scraping only touches what changed
+        replace_source(url, chunk_loader(json_chunks))
 
     except Exception as e:
         logger.error(f"✗ Error: {e}")
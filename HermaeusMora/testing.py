@@ -1,24 +1,45 @@
-from apocrypha.EpistolaryAcumen import RecallKnowledge
+from apocrypha.EpistolaryAcumen import RecallKnowledge, recover_shards
+from apocrypha.context_assembler import assemble_context
 from hermaeus.HermaMora import HermaeusMora
+from hermaeus.conversation_session import ConversationSession
+from hermaeus.semantic_cache import SemanticResponseCache
 from seekers.web_pages.test_cleanup import clean_wikipedia_html_file
 
+# repair a store left torn by an interrupted ingestion before answering from it
+recover_shards()
+
 HermaeusMora = HermaeusMora()
-HermaeusMora.create()
+HermaeusMora.create(preload=True)
+session = ConversationSession(HermaeusMora)
+response_cache = SemanticResponseCache()
 
 while True:
     prompt = input("> ")
 
     results = RecallKnowledge(prompt)
 
-    context = []
     for item in results:
         print("=" * 10)
         print(item["distance"])
         print(item["content"])
         print("=" * 10)
-        context.append(item["content"])
 
-    context_info = "\n".join(context)
+    context_info = assemble_context(results)
+
+    # paraphrases of an earlier question answered from the same context reuse its answer
+    cached = response_cache.lookup(prompt, context_info)
+    if cached is not None:
+        print(cached)
+        session.remember(prompt, cached)
+        continue
+
+    # print the reasoning and then the answer as they arrive
+    shown = None
+    for kind, delta in session.chat_stream(prompt, context_info):
+        if kind != shown:
+            print("\n" + "=" * 60)
+            shown = kind
+        print(delta, end="", flush=True)
+    print()
 
-    response = HermaeusMora.chat(prompt, context_info)
-    print(response)
+    response_cache.store(prompt, HermaeusMora.last_message["content"], context_info)
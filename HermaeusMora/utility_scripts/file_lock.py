@@ -0,0 +1,69 @@
+import os
+import time
+from pathlib import Path
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+POLL_INTERVAL = 0.05    # seconds between attempts while waiting for a lock held by another process
+
+
+class FileLock:
+    """
+    Exclusive lock shared between processes through a lock file.
+
+    The operating system drops the lock when its holder exits, so a crashed
+    process never leaves it taken. The lock is not re-entrant and does not
+    order threads of one process, pair it with a threading lock for that.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+
+    def acquire(self, blocking=True, timeout=None) -> bool:
+        """
+        :param blocking: wait for the lock instead of giving up at once
+        :param timeout: seconds to wait, None to wait indefinitely
+        :return: True if the lock was taken
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        file = open(self.path, "a+b")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                if os.name == "nt":
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._file = file
+                return True
+            except OSError:
+                if not blocking or (deadline is not None and time.monotonic() >= deadline):
+                    file.close()
+                    return False
+                time.sleep(POLL_INTERVAL)
+
+    def release(self) -> None:
+        file, self._file = self._file, None
+        if os.name == "nt":
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        file.close()
+
+    @property
+    def locked(self) -> bool:
+        """ :return: True while this object holds the lock """
+        return self._file is not None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
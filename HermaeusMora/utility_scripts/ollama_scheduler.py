@@ -0,0 +1,242 @@
+import asyncio
+import itertools
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+
+from utility_scripts.file_lock import FileLock, POLL_INTERVAL
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+# priority classes, most urgent first
+INTERACTIVE = "interactive"     # chat and generate
+QUERY = "query"                 # query embeddings of a recall
+INGESTION = "ingestion"         # embedding batches of RetainKnowledge and replace_source
+PRIORITIES = (INTERACTIVE, QUERY, INGESTION)
+
+OLLAMA_MAX_IN_FLIGHT = 4        # requests sent to Ollama at once, match OLLAMA_NUM_PARALLEL
+RESERVED_SLOTS = {INGESTION: 1}                         # slots a class leaves free for the classes above it
+CLASS_LIMITS = {INTERACTIVE: 2, QUERY: 2, INGESTION: 3}
+BUSY_LIMITS = {INGESTION: 1}                            # limit of a class while a class above it is running
+QUEUE_LIMITS = {INTERACTIVE: 16, QUERY: 64, INGESTION: 256}     # waiting requests before new ones are shed
+QUEUE_TIMEOUTS = {INTERACTIVE: 120.0, QUERY: 30.0, INGESTION: None}     # seconds, None to wait indefinitely
+WAIT_SAMPLES = 1024             # recent queue waits kept per class for the percentiles
+
+# Slot lock files shared by every process on the machine, one per OLLAMA_MAX_IN_FLIGHT slot,
+# None to only schedule the requests of this process
+SLOT_DIR = Path(tempfile.gettempdir()) / "hermaeus_ollama_slots"
+
+
+class OllamaOverloaded(RuntimeError):
+    """ A request was shed because its queue was full or it waited longer than its timeout. """
+
+
+class OllamaScheduler:
+    """
+    Admission control for the Ollama requests of this process.
+
+    Each request takes a slot of its priority class for as long as Ollama works on
+    it, streams included. A waiting request is admitted when its class is under its
+    limit, enough slots are free once the reserved ones are left alone, and no
+    admissible request of a more urgent class is waiting, so a bulk ingestion
+    cannot starve chat. Requests are shed with OllamaOverloaded when their queue is
+    full or they wait past their timeout.
+
+    Queues, class limits and priorities only order the requests of one process.
+    Between processes, such as the chat and a scraper ingesting in parallel, an
+    admitted request also takes one of max_in_flight slot lock files in slot_dir,
+    and a class with reserved slots never takes the first of them. So Ollama sees
+    at most max_in_flight requests from all processes together, and those reserved
+    slots stay free for chat while another process ingests. Across processes
+    there is no priority order beyond that, waiting requests poll for a free slot.
+    """
+
+    def __init__(self, max_in_flight=OLLAMA_MAX_IN_FLIGHT, class_limits=None, busy_limits=None,
+                 reserved_slots=None, queue_limits=None, queue_timeouts=None, slot_dir=SLOT_DIR):
+        """
+        :param max_in_flight: requests running at once over all classes
+        :param class_limits: requests of a class running at once
+        :param busy_limits: lower class limits while a more urgent class is running
+        :param reserved_slots: slots a class may not take, kept for the classes above it
+        :param queue_limits: requests of a class waiting at once
+        :param queue_timeouts: seconds a request of a class waits before it is shed
+        :param slot_dir: directory of the slot lock files shared with other processes, None to not share
+        """
+        self.max_in_flight = max_in_flight
+        self.class_limits = CLASS_LIMITS | (class_limits or {})
+        self.busy_limits = BUSY_LIMITS | (busy_limits or {})
+        self.reserved_slots = RESERVED_SLOTS | (reserved_slots or {})
+        self.queue_limits = QUEUE_LIMITS | (queue_limits or {})
+        self.queue_timeouts = QUEUE_TIMEOUTS | (queue_timeouts or {})
+        self.slot_dir = None if slot_dir is None else Path(slot_dir)
+
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+        self._waiting = {priority: deque() for priority in PRIORITIES}
+        self._active = dict.fromkeys(PRIORITIES, 0)
+        self._counters = {priority: dict.fromkeys(("admitted", "shed", "timed_out", "peak_queued"), 0)
+                          for priority in PRIORITIES}
+        self._waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in PRIORITIES}
+
+    # -------------------
+    # Admission
+    # -------------------
+
+    def _class_limit(self, priority: str) -> int:
+        limit = self.class_limits[priority]
+        above = PRIORITIES[:PRIORITIES.index(priority)]
+        if priority in self.busy_limits and any(self._active[other] for other in above):
+            limit = min(limit, self.busy_limits[priority])
+        return limit
+
+    def _can_run(self, priority: str) -> bool:
+        free = self.max_in_flight - sum(self._active.values())
+        return self._active[priority] < self._class_limit(priority) \
+            and free > self.reserved_slots.get(priority, 0)
+
+    def _admissible(self, priority: str, ticket: int) -> bool:
+        """ :return: True if the request is first in its queue, can run and no more urgent request can """
+        if self._waiting[priority][0] != ticket or not self._can_run(priority):
+            return False
+        above = PRIORITIES[:PRIORITIES.index(priority)]
+        return not any(self._waiting[other] and self._can_run(other) for other in above)
+
+    def acquire(self, priority: str = INTERACTIVE, timeout=None):
+        """
+        Wait for a slot of the priority class.
+        :param timeout: seconds to wait, the class's queue timeout if None
+        :return: the shared slot taken, to be passed to release
+        :raises OllamaOverloaded: if the queue is full or the wait timed out
+        """
+        if priority not in self._active:
+            raise ValueError(f"Unknown priority: {priority}")
+        timeout = self.queue_timeouts[priority] if timeout is None else timeout
+        counters = self._counters[priority]
+        queued = time.monotonic()
+        deadline = None if timeout is None else queued + timeout
+
+        with self._condition:
+            waiting = self._waiting[priority]
+            if len(waiting) >= self.queue_limits[priority]:
+                counters["shed"] += 1
+                logger.warning(f"Shedding {priority} request, {len(waiting)} already waiting")
+                raise OllamaOverloaded(f"Too many {priority} requests waiting for Ollama")
+
+            ticket = next(self._tickets)
+            waiting.append(ticket)
+            counters["peak_queued"] = max(counters["peak_queued"], len(waiting))
+            try:
+                while not self._admissible(priority, ticket):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        counters["timed_out"] += 1
+                        logger.warning(f"Shedding {priority} request after waiting {timeout:g}s")
+                        raise OllamaOverloaded(f"{priority} request waited longer than {timeout:g}s for Ollama")
+                    self._condition.wait(remaining)
+            finally:
+                waiting.remove(ticket)
+                # the queue head changed, let the next request check again
+                self._condition.notify_all()
+
+            self._active[priority] += 1
+
+        try:
+            shared = self._acquire_shared(priority, deadline)
+        except OllamaOverloaded:
+            with self._condition:
+                counters["timed_out"] += 1
+                self._active[priority] -= 1
+                self._condition.notify_all()
+            raise
+
+        with self._condition:
+            counters["admitted"] += 1
+            self._waits[priority].append(time.monotonic() - queued)
+        return shared
+
+    def _acquire_shared(self, priority: str, deadline):
+        """ :return: the slot lock file taken, None if slots are not shared with other processes """
+        if self.slot_dir is None:
+            return None
+        slots = [FileLock(self.slot_dir / f"slot-{number}.lock")
+                 for number in range(self.reserved_slots.get(priority, 0), self.max_in_flight)]
+        while True:
+            for slot in slots:
+                if slot.acquire(blocking=False):
+                    return slot
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning(f"Shedding {priority} request, every shared Ollama slot stayed taken")
+                raise OllamaOverloaded(f"{priority} request found no free Ollama slot")
+            time.sleep(POLL_INTERVAL)
+
+    def release(self, priority: str = INTERACTIVE, shared=None) -> None:
+        """ :param shared: the slot returned by acquire """
+        if shared is not None:
+            shared.release()
+        with self._condition:
+            self._active[priority] -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, priority: str = INTERACTIVE, timeout=None):
+        """ Hold a slot of the priority class for the duration of the with block. """
+        shared = self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release(priority, shared)
+
+    @asynccontextmanager
+    async def async_slot(self, priority: str = INTERACTIVE, timeout=None):
+        """ slot for an asyncio event loop, the wait runs in the loop's default executor. """
+        loop = asyncio.get_running_loop()
+        waiter = loop.run_in_executor(None, self.acquire, priority, timeout)
+        try:
+            shared = await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            # the slot may still be granted after the caller gave up on it
+            waiter.add_done_callback(
+                lambda done: done.cancelled() or done.exception() is not None or self.release(priority, done.result())
+            )
+            raise
+        try:
+            yield
+        finally:
+            self.release(priority, shared)
+
+    # -------------------
+    # Metrics
+    # -------------------
+
+    def metrics(self) -> dict:
+        """ :return: per class running and waiting requests, admission counters and queue wait percentiles """
+        with self._condition:
+            metrics = {}
+            for priority in PRIORITIES:
+                waits = sorted(self._waits[priority])
+                metrics[priority] = {
+                    "active": self._active[priority],
+                    "queued": len(self._waiting[priority]),
+                    **self._counters[priority],
+                    "wait_p50": waits[len(waits) // 2] if waits else 0.0,
+                    "wait_p99": waits[min(len(waits) - 1, int(len(waits) * 0.99))] if waits else 0.0,
+                }
+            return metrics
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> OllamaScheduler:
+    """ :return: the scheduler shared by every Ollama call of the process """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = OllamaScheduler()
+    return _scheduler
@@ -0,0 +1,44 @@
+import functools
+import math
+import threading
+
+from utility_scripts.system_logging import setup_logger
+
+# configure logging
+logger = setup_logger(__name__)
+
+TOKENIZER_ID = "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B"  # tokenizer of deepseek-r1:7b
+CHARS_PER_TOKEN = 3.5       # estimate used when the tokenizer cannot be loaded
+MESSAGE_OVERHEAD = 4        # role and chat template tokens per message
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """ :return: the Hugging Face tokenizer, loaded once, or None if it is unavailable """
+    global _tokenizer, _tokenizer_loaded
+    with _tokenizer_lock:
+        if not _tokenizer_loaded:
+            _tokenizer_loaded = True
+            try:
+                from transformers import AutoTokenizer
+                _tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_ID)
+            except (ImportError, OSError, ValueError) as e:
+                logger.warning(f"Tokenizer {TOKENIZER_ID} unavailable, estimating token counts: {e}")
+    return _tokenizer
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """ :return: number of tokens in text, repeated texts such as the system prompt are counted once """
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def count_message_tokens(messages) -> int:
+    """ :return: number of tokens a list of chat messages takes up in the context window """
+    return sum(count_tokens(message["content"]) + MESSAGE_OVERHEAD for message in messages)